@@ -0,0 +1,239 @@
+######################################
+
+# This script:
+# - benchmarks the local extraction path on synthetic event stores (lib/synthetic_store.py)
+#   at 100k and 1M patients by default
+# - times codelist loading, each variable in the study definition, the population filter,
+#   cohort writing, and reading the cohort back with the column types in 00_process_data.R
+# - stores the results as a machine-readable baseline (benchmarks/baseline.json) and compares
+#   later runs against it
+#
+# Usage:
+#   python lib/benchmark.py --sizes 1000000 --save-baseline
+#   python lib/benchmark.py --sizes 1000000                # compare with the stored baseline
+#
+# Each size runs in its own process, so peak RSS is per size. Extraction holds every variable and
+# its intermediates in memory: peak RSS is about 3.4 KB a patient (686 MB at 200k, ~100 GB at 30M),
+# and stores take about 1.5 KB a patient on disk. Sizes whose estimated peak is more than this
+# machine's memory are skipped, unless --force.
+
+######################################
+
+
+# --- IMPORT STATEMENTS ---
+
+import argparse
+import csv
+import json
+import os
+import platform
+import re
+import resource
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from pathlib import Path
+
+import numpy as np
+
+from event_store import TABLES, table_length
+from extraction_profile import ExtractionProfiler, VariableProfile
+from local_extraction import LocalExtractor, write_cohort
+from study_spec import load_study_definition
+from synthetic_store import generate_store
+
+
+ROOT = Path(__file__).resolve().parent.parent
+
+## Peak RSS per patient, measured at 100k and 200k patients (store pages included)
+BYTES_PER_PATIENT = 3_500
+
+
+# --- READING THE COHORT BACK ---
+
+_R_COLUMN = re.compile(r"^\s*(\w+)\s*=\s*col_(\w+)\(", re.MULTILINE)
+
+
+def r_schema(path=ROOT / "analysis" / "R" / "Scripts" / "00_process_data.R"):
+    ## Column types from the cols_only() specification in 00_process_data.R, so the two cannot drift apart
+    text = Path(path).read_text()
+    start = text.index("cols_only(")
+    return dict(_R_COLUMN.findall(text[start:text.index("na = character()", start)]))
+
+
+def _parse_column(values, kind):
+    ## One chunk of one column, with the type readr would give it
+    if kind in ("date", "study_date"):
+        return np.array(values, dtype="datetime64[D]")
+    if kind == "integer":
+        return np.array([int(value) if value else 0 for value in values], dtype=np.int64)
+    if kind == "double":
+        return np.array([float(value) if value else np.nan for value in values])
+    if kind == "logical":
+        return np.array(values) == "1"
+    return np.array(values)
+
+
+def read_cohort(path, schema, chunk_size=100_000):
+    ## Parse only the columns in the schema, chunk by chunk (as readr does), so only one chunk of rows
+    ## is held as Python strings; each column is converted to its array type as it is read
+    with open(path, newline="") as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        wanted = [(i, name) for i, name in enumerate(header) if name in schema]
+        chunks = {name: [] for _, name in wanted}
+        while True:
+            rows = [row for _, row in zip(range(chunk_size), reader)]
+            if not rows:
+                break
+            for i, name in wanted:
+                chunks[name].append(_parse_column([row[i] for row in rows], schema[name]))
+
+    ## string columns are padded to the widest value in any chunk
+    return {
+        name: np.concatenate(parts) if parts else _parse_column([], schema[name])
+        for name, parts in chunks.items()
+    }
+
+
+# --- BENCHMARK ---
+
+def timed(function, *args, **kwargs):
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def benchmark_size(n_patients, store_dir, study_definition="study_definition", seed=0):
+    store = Path(store_dir) / f"store_{n_patients}"
+    result = {"patients": n_patients}
+
+    if not (store / "patients" / "patient_id.npy").exists():
+        _, result["generate_store"] = timed(generate_store, store, n_patients, seed=seed)
+    result["store_rows"] = {table: table_length(store, table) for table in TABLES if (store / table).exists()}
+
+    ## Codelist loading: parse the study definition and read every codelist it uses on TPP (as extracted below)
+    def load_codelists():
+        study = load_study_definition(study_definition, ROOT / "analysis")
+        for spec in study.walk():
+            codelist = spec.backend_codelist("tpp")
+            if codelist is not None:
+                codelist.load()
+        return study
+
+    study, result["codelist_loading"] = timed(load_codelists)
+
+    ## Extraction: per-variable timings from the profiler (memory tracking off, it slows the timed code)
+    profiler = ExtractionProfiler(track_memory=False)
+    extractor = LocalExtractor(study, store, profiler=profiler)
+    cohort, result["extraction"] = timed(extractor.extract)
+
+    cohort_path = Path(store_dir) / f"input_{n_patients}.csv"
+    with profiler.measure(VariableProfile(name="write_cohort", kind="stage")):
+        write_cohort(cohort, cohort_path, study)
+
+    for record in profiler.records:
+        if record.kind == "stage":
+            result[record.name] = record.wall_time
+    result["variables"] = {record.name: record.wall_time for record in profiler.records if record.kind == "variable"}
+    result["cohort_rows"] = len(cohort["patient_id"])
+    result["cohort_bytes"] = os.path.getsize(cohort_path)
+
+    _, result["read_cohort"] = timed(read_cohort, cohort_path, r_schema())
+
+    result["peak_rss"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+    return result
+
+
+def physical_memory():
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def environment():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=ROOT, capture_output=True, text=True).stdout.strip()
+    except FileNotFoundError:
+        commit = None
+    return {
+        "created": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "git_commit": commit,
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+    }
+
+
+# --- COMPARISON ---
+
+def compare(results, baseline, tolerance, min_seconds=0.05):
+    ## Print each timing against the baseline; return the timings more than `tolerance` slower
+    ## (ignoring differences under min_seconds, which are timer noise for the fastest variables)
+    regressions = []
+    for size, result in results.items():
+        before = baseline.get("results", {}).get(size)
+        if before is None:
+            print(f"{size}: no baseline at this size")
+            continue
+        timings = {key: value for key, value in result.items() if isinstance(value, float)}
+        timings.update({f"variable:{name}": value for name, value in result["variables"].items()})
+        previous = {key: value for key, value in before.items() if isinstance(value, float)}
+        previous.update({f"variable:{name}": value for name, value in before.get("variables", {}).items()})
+        for key, value in timings.items():
+            if key not in previous or previous[key] <= 0:
+                continue
+            ratio = value / previous[key]
+            flag = "  REGRESSION" if ratio > 1 + tolerance and value - previous[key] > min_seconds else ""
+            print(f"{size:>10} {key:<50} {previous[key]:10.3f}s -> {value:10.3f}s  x{ratio:5.2f}{flag}")
+            if flag:
+                regressions.append((size, key, ratio))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark local extraction on synthetic event stores")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100_000, 1_000_000])
+    parser.add_argument("--stores", default=str(ROOT / "output" / "benchmarks"), help="where synthetic stores are kept")
+    parser.add_argument("--study-definition", default="study_definition")
+    parser.add_argument("--baseline", default=str(ROOT / "benchmarks" / "baseline.json"))
+    parser.add_argument("--output", help="also write this run's results here")
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    parser.add_argument("--force", action="store_true", help="run sizes estimated not to fit in memory")
+    args = parser.parse_args(argv)
+
+    Path(args.stores).mkdir(parents=True, exist_ok=True)
+    results = {}
+    memory = physical_memory()
+    for size in args.sizes:
+        if memory is not None and size * BYTES_PER_PATIENT > memory and not args.force:
+            print(f"skipping {size:,} patients: needs about {size * BYTES_PER_PATIENT / 1e9:.0f} GB, "
+                  f"this machine has {memory / 1e9:.0f} GB (--force to run anyway)", flush=True)
+            continue
+        print(f"benchmarking {size:,} patients", flush=True)
+        with ProcessPoolExecutor(max_workers=1) as pool:
+            results[str(size)] = pool.submit(benchmark_size, size, args.stores, args.study_definition).result()
+
+    run = dict(environment(), study_definition=args.study_definition, results=results)
+    if args.output:
+        Path(args.output).write_text(json.dumps(run, indent=2))
+
+    regressions = []
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        regressions = compare(results, json.loads(Path(args.baseline).read_text()), args.tolerance)
+    if args.save_baseline:
+        Path(args.baseline).parent.mkdir(parents=True, exist_ok=True)
+        Path(args.baseline).write_text(json.dumps(run, indent=2))
+        print(f"baseline written to {args.baseline}")
+
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
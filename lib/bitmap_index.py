@@ -0,0 +1,214 @@
+######################################
+
+# This script:
+# - builds a bitmap index over an extracted cohort: one bitset per binary covariate, and per level
+#   of ageband, sex, imd and ethnicity, with one bit per row of the cohort file
+# - answers subgroup counts, flow-chart cascades and two-way cross-tabs with bitwise AND and a
+#   popcount, instead of filtering the row-level data
+# - is written by lib/local_extraction.py with --bitmap-index (input.csv -> input_bitmaps.npz)
+#
+# Usage:
+#   python lib/bitmap_index.py output/input_bitmaps.npz count diabetes sex=F
+#   python lib/bitmap_index.py output/input_bitmaps.npz crosstab ageband sex
+#   python lib/bitmap_index.py output/input_flow_chart_bitmaps.npz cascade registered !has_died has_follow_up_previous_year
+#
+# Bitsets are named after the column for flags (eg diabetes, or sev_mental_ill for a date that
+# is present), and column=level for categories (eg ageband=70-74, imd=1). A leading ! negates.
+# Covariates derived in 00_process_data.R (ageband, ethnicity groups 17-20, ckd, immunosuppression,
+# morbid_obesity) are derived here the same way, when the columns they need are in the cohort.
+
+######################################
+
+
+# --- IMPORT STATEMENTS ---
+
+import argparse
+from pathlib import Path
+
+import numpy as np
+
+
+# --- DERIVED COVARIATES ---
+
+AGEBANDS = ((70, 75, "70-74"), (75, 80, "75-79"), (80, 85, "80-84"), (85, 90, "85-89"), (90, 95, "90-94"), (95, np.inf, "95+"))
+
+CATEGORIES = ("sex", "imd", "ethnicity")
+
+
+def _present(values):
+    ## A flag is set if it is 1, or if a date column has a date (as !is.na() in 00_process_data.R)
+    values = np.asarray(values)
+    if values.dtype.kind == "M":
+        return ~np.isnat(values)
+    return values == 1
+
+
+def derived_flags(cohort):
+    ## Same definitions as 00_process_data.R
+    flags = {}
+    if {"immunosuppression_diagnosis", "immunosuppression_medication"} <= set(cohort):
+        flags["immunosuppression"] = _present(cohort["immunosuppression_diagnosis"]) | _present(cohort["immunosuppression_medication"])
+    if {"chronic_kidney_disease_diagnostic", "chronic_kidney_disease_all_stages", "chronic_kidney_disease_all_stages_3_5"} <= set(cohort):
+        all_stages = cohort["chronic_kidney_disease_all_stages"]
+        stages_3_5 = cohort["chronic_kidney_disease_all_stages_3_5"]
+        flags["ckd"] = _present(cohort["chronic_kidney_disease_diagnostic"]) | (
+            _present(all_stages) & _present(stages_3_5) & (stages_3_5 >= all_stages)
+        )
+    if {"bmi", "sev_obesity", "bmi_stage_date"} <= set(cohort):
+        ## a recorded bmi of 40+, or a severe obesity code on or after the bmi stage code (only with a recorded bmi)
+        bmi = np.asarray(cohort["bmi"], dtype=float)
+        recorded = ~np.isnan(bmi) & (bmi != 0)
+        staged = _present(cohort["sev_obesity"]) & _present(cohort["bmi_stage_date"]) & (cohort["sev_obesity"] >= cohort["bmi_stage_date"])
+        flags["morbid_obesity"] = recorded & ((bmi >= 40) | staged)
+    if {"chronic_neuro_dis_inc_sig_learn_dis", "learning_disability"} <= set(cohort):
+        flags["chronic_neuro_dis_inc_sig_learn_dis"] = _present(cohort["chronic_neuro_dis_inc_sig_learn_dis"]) | _present(cohort["learning_disability"])
+    return flags
+
+
+def derived_categories(cohort):
+    categories = {}
+    if "age" in cohort:
+        age = np.asarray(cohort["age"])
+        categories["ageband"] = {label: (age >= low) & (age < high) for low, high, label in AGEBANDS}
+    if "ethnicity" in cohort:
+        ## missing ethnicity falls back to the "other", "not given", "not stated" and "no record" codes, then 20
+        ethnicity = np.asarray(cohort["ethnicity"]).astype(str)
+        for column, code in (("ethnicity_other", "17"), ("ethnicity_not_given", "18"),
+                             ("ethnicity_not_stated", "19"), ("ethnicity_no_record", "20")):
+            if column in cohort:
+                ethnicity = np.where((ethnicity == "") & _present(cohort[column]), code, ethnicity)
+        ethnicity = np.where(ethnicity == "", "20", ethnicity)
+        categories["ethnicity"] = {level: ethnicity == level for level in np.unique(ethnicity)}
+    for name in ("sex", "imd"):
+        if name in cohort:
+            values = np.asarray(cohort[name]).astype(str)
+            categories[name] = {level: values == level for level in np.unique(values) if level not in ("", "0")}
+    return categories
+
+
+# --- INDEX ---
+
+if hasattr(np, "bitwise_count"):
+    def _popcount(packed):
+        return int(np.bitwise_count(packed).sum(dtype=np.int64))
+else:
+    _POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+    def _popcount(packed):
+        return int(_POPCOUNT[packed].sum(dtype=np.int64))
+
+
+class BitmapIndex:
+
+    ## Bitsets are packed 8 rows to a byte; bits past the last row are always 0
+
+    def __init__(self, n, bitsets):
+        self.n = n
+        self.bitsets = bitsets
+
+    @classmethod
+    def build(cls, cohort, study):
+        flags = {}
+        for variable in study.variables:
+            if variable.returning in ("binary_flag", "date", "date_of_death") and variable.name in cohort:
+                flags[variable.name] = _present(cohort[variable.name])
+        flags.update(derived_flags(cohort))
+
+        bitsets = {name: np.packbits(values) for name, values in flags.items()}
+        for name, levels in derived_categories(cohort).items():
+            for level, values in levels.items():
+                bitsets[f"{name}={level}"] = np.packbits(values)
+        return cls(len(cohort["patient_id"]), bitsets)
+
+    def save(self, path):
+        np.savez_compressed(path, __n__=np.array([self.n]), **self.bitsets)
+        return Path(path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            bitsets = {name: data[name] for name in data.files if name != "__n__"}
+            return cls(int(data["__n__"][0]), bitsets)
+
+    def levels(self, variable):
+        return [name.split("=", 1)[1] for name in self.bitsets if name.startswith(f"{variable}=")]
+
+    def bitset(self, name):
+        if name.startswith("!"):
+            ## invert, then clear the padding bits past the last row
+            packed = np.invert(self.bitset(name[1:]))
+            if self.n % 8:
+                packed[-1] &= np.uint8((0xFF << (8 - self.n % 8)) & 0xFF)
+            return packed
+        if name not in self.bitsets:
+            raise KeyError(f"no bitset '{name}'; available: {', '.join(self.bitsets)}")
+        return self.bitsets[name]
+
+    def select(self, *names):
+        ## AND of the named bitsets (all rows if none)
+        packed = np.packbits(np.ones(self.n, dtype=bool))
+        for name in names:
+            packed = packed & self.bitset(name)
+        return packed
+
+    def count(self, *names):
+        return _popcount(self.select(*names))
+
+    def mask(self, *names):
+        return np.unpackbits(self.select(*names), count=self.n).astype(bool)
+
+    def cascade(self, names):
+        ## Rows remaining after each criterion in turn, as in the study flow chart
+        packed = self.select()
+        counts = [("all", self.n)]
+        for name in names:
+            packed = packed & self.bitset(name)
+            counts.append((name, _popcount(packed)))
+        return counts
+
+    def crosstab(self, rows, columns, *where):
+        ## Counts for every level of `rows` by every level of `columns`, within the `where` bitsets
+        base = self.select(*where)
+        row_levels, column_levels = self.levels(rows), self.levels(columns)
+        table = np.zeros((len(row_levels), len(column_levels)), dtype=np.int64)
+        for i, row in enumerate(row_levels):
+            within = base & self.bitset(f"{rows}={row}")
+            for j, column in enumerate(column_levels):
+                table[i, j] = _popcount(within & self.bitset(f"{columns}={column}"))
+        return row_levels, column_levels, table
+
+
+def index_path(cohort_path):
+    ## Named after the cohort file, eg input.csv -> input_bitmaps.npz
+    cohort_path = Path(cohort_path)
+    return cohort_path.parent / f"{cohort_path.stem}_bitmaps.npz"
+
+
+# --- COMMAND LINE ---
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Counts, cascades and cross-tabs from a cohort bitmap index")
+    parser.add_argument("index", help="bitmap index, eg output/input_bitmaps.npz")
+    parser.add_argument("query", choices=["list", "count", "cascade", "crosstab"])
+    parser.add_argument("names", nargs="*", help="bitsets (count, cascade) or two variables then bitsets (crosstab)")
+    args = parser.parse_args(argv)
+
+    index = BitmapIndex.load(args.index)
+    if args.query == "list":
+        for name, packed in index.bitsets.items():
+            print(f"{name:<50} {_popcount(packed):>10}")
+    elif args.query == "count":
+        print(index.count(*args.names))
+    elif args.query == "cascade":
+        for name, count in index.cascade(args.names):
+            print(f"{name:<50} {count:>10}")
+    else:
+        rows, columns, *where = args.names
+        row_levels, column_levels, table = index.crosstab(rows, columns, *where)
+        print(f"{rows + ' / ' + columns:<20}" + "".join(f"{level:>12}" for level in column_levels))
+        for level, counts in zip(row_levels, table):
+            print(f"{level:<20}" + "".join(f"{count:>12}" for count in counts))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+######################################
+
+# This script:
+# - encodes cohort dates as int16 day offsets from index_date (lib/local_extraction.py --date-offsets)
+# - writes and reads the sidecar that describes the encoding (input.csv -> input_date_offsets.json),
+#   read by 00_process_data.R and lib/sketches.py
+#
+# The sidecar records the md5 of the cohort file it describes. A sidecar whose md5 doesn't match
+# the cohort file (eg left over from an earlier extraction, or a cohort restored from a cache) is
+# not applied, so ISO dates are never read as offsets.
+
+######################################
+
+
+# --- IMPORT STATEMENTS ---
+
+import hashlib
+import json
+from pathlib import Path
+
+import numpy as np
+
+
+DATE_UNITS = {None: "D", "YYYY-MM-DD": "D", "YYYY-MM": "M", "YYYY": "Y"}
+
+NAT = np.datetime64("NaT", "D")
+
+
+# --- ENCODING ---
+
+class DateOffsets:
+
+    ## Dates as signed int16 numbers of days from index_date, with -32768 for missing. Covers
+    ## index_date +/- 89 years. Used to write the cohort CSV a chunk at a time, where an offset is at
+    ## most 6 characters rather than a 10 character ISO date, and to read it back.
+
+    MISSING = np.iinfo(np.int16).min
+
+    def __init__(self, index_date):
+        self.index_date = np.datetime64(index_date, "D")
+
+    def encode(self, values, date_format=None):
+        values = values.astype(f"datetime64[{DATE_UNITS[date_format]}]").astype("datetime64[D]")
+        missing = np.isnat(values)
+        offsets = np.where(missing, 0, (values - self.index_date).astype(np.int64))
+        if len(offsets) and (offsets.min() <= self.MISSING or offsets.max() > np.iinfo(np.int16).max):
+            raise ValueError(f"dates more than 32767 days from {self.index_date} can't be stored as int16 offsets")
+        return np.where(missing, self.MISSING, offsets).astype(np.int16)
+
+    def format(self, offsets):
+        ## As text, missing is an empty string, as for ISO dates
+        return np.where(offsets == self.MISSING, "", offsets.astype(str))
+
+    def decode(self, offsets):
+        offsets = np.asarray(offsets)
+        return np.where(offsets == self.MISSING, NAT, self.index_date + offsets.astype(np.int64))
+
+    def write(self, path, columns, cohort_path):
+        ## Sidecar for readers of the cohort file, tied to that file by its md5
+        with open(path, "w") as f:
+            json.dump({
+                "index_date": str(self.index_date),
+                "missing": int(self.MISSING),
+                "columns": columns,
+                "cohort": Path(cohort_path).name,
+                "cohort_md5": file_md5(cohort_path),
+            }, f, indent=2)
+
+
+# --- SIDECAR ---
+
+def file_md5(path, block_size=1 << 20):
+    ## md5, as tools::md5sum() in R
+    digest = hashlib.md5()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def date_offsets_path(cohort_path):
+    ## eg input.csv -> input_date_offsets.json
+    cohort_path = Path(cohort_path)
+    return cohort_path.parent / f"{cohort_path.stem}_date_offsets.json"
+
+
+def read_date_offsets(cohort_path):
+    ## The sidecar for a cohort file, or None if there is none or it describes a different file
+    path = date_offsets_path(cohort_path)
+    if not path.exists():
+        return None
+    sidecar = json.loads(path.read_text())
+    if sidecar.get("cohort_md5") != file_md5(cohort_path):
+        return None
+    return sidecar
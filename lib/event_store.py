@@ -0,0 +1,229 @@
+######################################
+
+# This script:
+# - defines the on-disk layout of the local event store read by lib/local_extraction.py
+# - each table is a directory holding one .npy file per column
+# - rows are sorted by patient_id (and by date within patient for event tables), which the
+#   extraction relies on to reduce matches to one value per patient without a further sort
+# - event tables can instead be partitioned by event year/month: rows sorted by month, then by
+#   patient_id and date within each month, with a zone map (<table>/zone_maps.json) giving each
+#   month's row range and min/max date and code, so queries can skip whole partitions
+#
+# Usage (partition the event tables of an existing store, in place):
+#   python lib/event_store.py output/event_store
+
+######################################
+
+
+# --- IMPORT STATEMENTS ---
+
+import argparse
+import json
+from pathlib import Path
+
+import numpy as np
+
+
+# --- SCHEMA ---
+
+DATE = "datetime64[D]"
+
+TABLES = {
+    "patients": {
+        "patient_id": "int64",
+        "date_of_birth": DATE,
+        "sex": "<U1",
+        "date_of_death": DATE,
+    },
+    "registrations": {
+        "patient_id": "int64",
+        "practice_pseudo_id": "int64",
+        "start_date": DATE,
+        "end_date": DATE,
+    },
+    "addresses": {
+        "patient_id": "int64",
+        "start_date": DATE,
+        "end_date": DATE,
+        "index_of_multiple_deprivation": "int64",
+    },
+    "clinical_events": {
+        "patient_id": "int64",
+        "date": DATE,
+        "code": "int64",
+        "numeric_value": "float64",
+    },
+    "medications": {
+        "patient_id": "int64",
+        "date": DATE,
+        "code": "int64",
+    },
+    "vaccinations": {
+        "patient_id": "int64",
+        "date": DATE,
+        "target_disease": "<U32",
+    },
+    ## EMIS-shaped stores record vaccinations as immunisation procedure codes, in place of the
+    ## TPP-shaped vaccinations table with its target disease
+    "immunisations": {
+        "patient_id": "int64",
+        "date": DATE,
+        "code": "int64",
+    },
+}
+
+SORT_KEYS = {
+    "patients": ("patient_id",),
+    "registrations": ("patient_id", "start_date"),
+    "addresses": ("patient_id", "start_date"),
+    "clinical_events": ("patient_id", "date"),
+    "medications": ("patient_id", "date"),
+    "vaccinations": ("patient_id", "date"),
+    "immunisations": ("patient_id", "date"),
+}
+
+EVENT_TABLES = ("clinical_events", "medications", "vaccinations", "immunisations")
+
+
+# --- READ/WRITE ---
+
+def write_table(root, table, columns):
+    ## Validate against the schema, sort, and write one file per column
+    with TableWriter(root, table) as writer:
+        writer.append(columns)
+
+
+class TableWriter:
+
+    ## Appends chunks to a table without holding it all in memory (eg for large synthetic stores).
+    ## Chunks must arrive in sort order: each chunk sorted, and patient_ids not decreasing across chunks.
+
+    HEADER_LENGTH = 128
+
+    def __init__(self, root, table):
+        self.schema = TABLES[table]
+        self.table = table
+        self.directory = Path(root) / table
+        self.directory.mkdir(parents=True, exist_ok=True)
+        ## a rewritten table is in patient order, so any zone map from partitioning no longer applies
+        (self.directory / "zone_maps.json").unlink(missing_ok=True)
+        self.files = {name: open(self.directory / f"{name}.npy", "wb") for name in self.schema}
+        self.length = 0
+        self.last_patient_id = None
+        for name, f in self.files.items():
+            f.write(self._header(name, 0))
+
+    def _header(self, name, length):
+        ## Fixed-length .npy header, so it can be rewritten in place with the final length
+        header = repr({"descr": np.lib.format.dtype_to_descr(np.dtype(self.schema[name])), "fortran_order": False, "shape": (length,)})
+        prefix = np.lib.format.magic(1, 0)
+        padding = self.HEADER_LENGTH - len(prefix) - 2 - len(header) - 1
+        return prefix + np.uint16(self.HEADER_LENGTH - len(prefix) - 2).tobytes() + (header + " " * padding + "\n").encode("latin1")
+
+    def append(self, columns):
+        missing = set(self.schema) - set(columns)
+        if missing:
+            raise ValueError(f"{self.table}: missing columns {sorted(missing)}")
+        arrays = {name: np.asarray(columns[name]).astype(dtype, copy=False) for name, dtype in self.schema.items()}
+        if len({len(array) for array in arrays.values()}) != 1:
+            raise ValueError(f"{self.table}: columns have different lengths")
+        order = np.lexsort([arrays[key] for key in reversed(SORT_KEYS[self.table])])
+        patient_ids = arrays["patient_id"][order]
+        if len(patient_ids) == 0:
+            return
+        if self.last_patient_id is not None and patient_ids[0] < self.last_patient_id:
+            raise ValueError(f"{self.table}: chunks must be appended in patient_id order")
+        self.last_patient_id = patient_ids[-1]
+        for name, array in arrays.items():
+            self.files[name].write(np.ascontiguousarray(array[order]).tobytes())
+        self.length += len(order)
+
+    def close(self):
+        for name, f in self.files.items():
+            f.seek(0)
+            f.write(self._header(name, self.length))
+            f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def read_table(root, table, columns=None):
+    ## Columns are memory-mapped, so only the pages a query touches are read from disk.
+    ## A partitioned table comes back in month order (see zone_maps)
+    directory = Path(root) / table
+    if not directory.exists():
+        raise FileNotFoundError(f"event store {root} has no '{table}' table")
+    names = columns if columns is not None else list(TABLES[table])
+    return {name: np.load(directory / f"{name}.npy", mmap_mode="r") for name in names}
+
+
+def table_length(root, table):
+    return len(np.load(Path(root) / table / "patient_id.npy", mmap_mode="r"))
+
+
+# --- PARTITIONS ---
+
+def is_partitioned(root, table):
+    return (Path(root) / table / "zone_maps.json").exists()
+
+
+def zone_maps(root, table):
+    return json.loads((Path(root) / table / "zone_maps.json").read_text())
+
+
+def partition_label(month):
+    ## "YYYY-MM" for a datetime64[M] month, or "none" for events without a date
+    return "none" if np.isnat(month) else str(month)
+
+
+def partition_table(root, table):
+    ## Rewrites a table in month order with a zone map per month. A stable sort on the month keeps
+    ## each month in patient_id, date order. The table is read into memory, one table at a time
+    directory = Path(root) / table
+    columns = {name: np.array(values) for name, values in read_table(root, table).items()}
+    months = columns["date"].astype("datetime64[M]")
+    order = np.argsort(months.view(np.int64), kind="stable")
+    months = months[order]
+    columns = {name: values[order] for name, values in columns.items()}
+    starts = np.flatnonzero(np.r_[True, months[1:] != months[:-1]]) if len(months) else np.zeros(0, dtype=int)
+    ends = np.r_[starts[1:], len(months)].astype(int)
+
+    zones = []
+    for start, end in zip(starts, ends):
+        key = partition_label(months[start])
+        zone = {"partition": key, "start": int(start), "end": int(end), "min_date": None, "max_date": None}
+        if key != "none":
+            dates = columns["date"][start:end]
+            zone["min_date"], zone["max_date"] = str(dates.min()), str(dates.max())
+        if "code" in columns and columns["code"].dtype.kind in "iu":
+            codes = columns["code"][start:end]
+            zone["min_code"], zone["max_code"] = int(codes.min()), int(codes.max())
+        zones.append(zone)
+
+    for name, values in columns.items():
+        np.save(directory / f"{name}.npy", values)
+    (directory / "zone_maps.json").write_text(json.dumps(zones, indent=2))
+    return zones
+
+
+# --- COMMAND LINE ---
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Partition the event tables of a local event store by event year/month")
+    parser.add_argument("store")
+    parser.add_argument("--tables", nargs="+", default=list(EVENT_TABLES), choices=EVENT_TABLES)
+    args = parser.parse_args(argv)
+
+    for table in args.tables:
+        if not (Path(args.store) / table).exists() or is_partitioned(args.store, table):
+            continue
+        zones = partition_table(args.store, table)
+        print(f"{table:<20} {len(zones):>6} partitions {table_length(args.store, table):>12,} rows")
+
+
+if __name__ == "__main__":
+    main()
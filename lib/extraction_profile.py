@@ -0,0 +1,148 @@
+######################################
+
+# This script:
+# - records per-variable extraction statistics for lib/local_extraction.py:
+#   wall time, rows scanned, rows matched, peak memory and codelist size
+# - lets other profilers subscribe to start/end events for each variable (see register_hook)
+# - writes the records as a JSON and a CSV sidecar next to the extracted cohort
+#   (eg output/input.csv -> output/input_profile.json, output/input_profile.csv)
+
+######################################
+
+
+# --- IMPORT STATEMENTS ---
+
+import csv
+import json
+import time
+import tracemalloc
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, fields
+from pathlib import Path
+from typing import Optional
+
+
+# --- RECORDS ---
+
+@dataclass
+class VariableProfile:
+    name: str
+    kind: str = "variable"  # "variable" or "stage" (eg population filter, cohort writing)
+    function: Optional[str] = None
+    returning: Optional[str] = None
+    hidden: bool = False
+    codelist_size: Optional[int] = None
+    rows_scanned: int = 0
+    rows_matched: int = 0
+    wall_time: float = 0.0
+    peak_memory: Optional[int] = None
+
+
+# --- HOOKS ---
+
+## Hooks are called as hook(event, record) with event "start" or "end".
+## They apply to every profiler, so external tools can subscribe without access to the extraction.
+_HOOKS = []
+
+
+def register_hook(hook):
+    _HOOKS.append(hook)
+    return hook
+
+
+def unregister_hook(hook):
+    _HOOKS.remove(hook)
+
+
+# --- PROFILER ---
+
+class ExtractionProfiler:
+
+    def __init__(self, track_memory=True):
+        self.track_memory = track_memory
+        self.records = []
+        self._subscribers = []
+
+    def subscribe(self, hook):
+        self._subscribers.append(hook)
+        return hook
+
+    def _emit(self, event, record):
+        for hook in _HOOKS + self._subscribers:
+            hook(event, record)
+
+    @contextmanager
+    def measure(self, record):
+        self._emit("start", record)
+        if self.track_memory:
+            baseline = _start_peak()
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record.wall_time = time.perf_counter() - start
+            if self.track_memory:
+                record.peak_memory = tracemalloc.get_traced_memory()[1] - baseline
+            self.records.append(record)
+            self._emit("end", record)
+
+    def close(self):
+        if self.track_memory and tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+    def write(self, cohort_path, **metadata):
+        ## Sidecars are named after the cohort file, eg input.csv -> input_profile.{json,csv}
+        cohort_path = Path(cohort_path)
+        stem = cohort_path.parent / f"{cohort_path.stem}_profile"
+
+        variables = [record for record in self.records if record.kind == "variable"]
+        summary = dict(
+            metadata,
+            cohort=str(cohort_path),
+            total_time=sum(record.wall_time for record in self.records),
+            variable_time=sum(record.wall_time for record in variables),
+            slowest=[record.name for record in sorted(variables, key=lambda r: r.wall_time, reverse=True)[:5]],
+            records=[asdict(record) for record in self.records],
+        )
+        with open(f"{stem}.json", "w") as f:
+            json.dump(summary, f, indent=2, default=str)
+
+        with open(f"{stem}.csv", "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=[field.name for field in fields(VariableProfile)])
+            writer.writeheader()
+            for record in self.records:
+                writer.writerow(asdict(record))
+
+        return Path(f"{stem}.json"), Path(f"{stem}.csv")
+
+
+class NullProfiler(ExtractionProfiler):
+
+    ## Used when profiling is off: hooks still fire, but nothing is timed or kept
+
+    def __init__(self):
+        super().__init__(track_memory=False)
+
+    @contextmanager
+    def measure(self, record):
+        if _HOOKS or self._subscribers:
+            self._emit("start", record)
+            try:
+                yield record
+            finally:
+                self._emit("end", record)
+        else:
+            yield record
+
+
+def _start_peak():
+    ## Peak memory is measured per variable: reset the high-water mark and return the memory already in
+    ## use (eg cached tables), so that the record holds only what the variable itself allocated
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+    elif hasattr(tracemalloc, "reset_peak"):
+        tracemalloc.reset_peak()
+    else:
+        tracemalloc.stop()
+        tracemalloc.start()
+    return tracemalloc.get_traced_memory()[0]
@@ -0,0 +1,682 @@
+######################################
+
+# This script:
+# - evaluates a study definition (eg analysis/study_definition.py) against a local event store
+#   (see lib/event_store.py) without a database or cohortextractor
+# - writes the cohort in the same shape as `cohortextractor generate_cohort`, eg output/input.csv
+# - summarises the cohort with streaming sketches as it is written (output/input_sketch.json,
+#   see lib/sketches.py)
+# - optionally profiles each variable (--profile), writing output/input_profile.{json,csv}
+# - optionally writes a bitmap index of the binary and categorical covariates (--bitmap-index),
+#   output/input_bitmaps.npz, for fast subgroup counts (see lib/bitmap_index.py)
+# - optionally writes dates as int16 day offsets from index_date (--date-offsets), described in
+#   output/input_date_offsets.json, which 00_process_data.R reads back (see lib/date_offsets.py)
+#
+# Usage:
+#   python lib/local_extraction.py --study-definition study_definition --store output/event_store --profile
+#
+# Every variable is computed for every patient in the store as a numpy array, then the
+# population filter is applied once at the end. In a store with partitioned event tables, each
+# query only reads the year/month partitions whose zone map overlaps its date window and codelist.
+
+######################################
+
+
+# --- IMPORT STATEMENTS ---
+
+import argparse
+import ast
+import csv
+import operator
+import re
+from functools import lru_cache
+from pathlib import Path
+
+import numpy as np
+
+from bitmap_index import BitmapIndex, index_path
+from date_offsets import DATE_UNITS, DateOffsets, date_offsets_path, file_md5
+from event_store import TABLES, is_partitioned, read_table, zone_maps
+from extraction_profile import ExtractionProfiler, NullProfiler, VariableProfile
+from sketches import CohortSketch, sketch_path
+from study_spec import load_study_definition
+
+
+# --- DATES ---
+
+NAT = np.datetime64("NaT", "D")
+OPEN_END = np.datetime64("9999-12-31", "D")
+
+_DATE_EXPRESSION = re.compile(
+    r"^\s*(?P<reference>[\w-]+?)\s*(?:(?P<sign>[+-])\s*(?P<n>\d+)\s*(?P<unit>days?|months?|years?))?\s*$"
+)
+_ISO_DATE = re.compile(r"^\d{4}-\d{2}-\d{2}$")
+
+
+@lru_cache(maxsize=None)
+def parse_date_expression(value):
+    ## "index_date - 1 year" -> ("index_date", "month", -12); "bmi_stage_date" -> ("bmi_stage_date", None, 0)
+    match = _DATE_EXPRESSION.match(value)
+    if match is None:
+        raise ValueError(f"cannot parse date expression '{value}'")
+    if not match.group("sign"):
+        return match.group("reference"), None, 0
+    n = int(match.group("n")) * (1 if match.group("sign") == "+" else -1)
+    unit = match.group("unit").rstrip("s")
+    if unit == "year":
+        return match.group("reference"), "month", n * 12
+    return match.group("reference"), unit, n
+
+
+def add_months(dates, months):
+    ## Calendar arithmetic on datetime64[D] (scalars or arrays); day of month is clipped to the month end
+    dates = np.asarray(dates, dtype="datetime64[D]")
+    month_start = dates.astype("datetime64[M]")
+    day = dates - month_start.astype("datetime64[D]")
+    target = month_start + np.asarray(months)
+    month_end = (target + 1).astype("datetime64[D]") - 1
+    result = np.minimum(target.astype("datetime64[D]") + day, month_end)
+    return result[()] if result.ndim == 0 else result
+
+
+# --- EXPRESSIONS ---
+
+_TOKENS = re.compile(r'"[^"]*"|\'[^\']*\'|<=|>=|!=|==|=|\d+(?:\.\d+)?|\w+|\S')
+_COMPARISONS = {
+    ast.Eq: operator.eq,
+    ast.NotEq: operator.ne,
+    ast.Lt: operator.lt,
+    ast.LtE: operator.le,
+    ast.Gt: operator.gt,
+    ast.GtE: operator.ge,
+}
+
+
+def parse_expression(expression):
+    ## cohortextractor expressions use SQL-style AND/OR/NOT and "="; translate to python and parse
+    tokens = []
+    for token in _TOKENS.findall(expression):
+        if token == "=":
+            token = "=="
+        elif token.upper() in ("AND", "OR", "NOT"):
+            token = token.lower()
+        tokens.append(token)
+    return ast.parse(" ".join(tokens), mode="eval").body
+
+
+def truthy(values):
+    values = np.asarray(values)
+    if values.dtype.kind == "M":
+        return ~np.isnat(values)
+    if values.dtype.kind in "US":
+        return values != ""
+    return values != 0
+
+
+# --- EXTRACTION ---
+
+## Reductions that count matches per patient, so do not depend on row order
+UNORDERED = ("binary_flag", "number_of_matches_in_period")
+
+class LocalExtractor:
+
+    def __init__(self, study, store, backend="tpp", profiler=None):
+        self.study = study
+        self.store = Path(store)
+        self.backend = backend
+        self.profiler = profiler if profiler is not None else NullProfiler()
+        self.index_date = np.datetime64(study.index_date, "D")
+
+        self.patients = read_table(self.store, "patients")
+        self.patient_id = np.asarray(self.patients["patient_id"])
+        self.n = len(self.patient_id)
+
+        self.values = {}
+        self.specs = {}
+        self._tables = {}
+        self._zones = {}
+        self._dates = {}
+        self._record = VariableProfile(name="")
+
+    ## Tables ----
+
+    def table(self, name):
+        ## Event tables plus the position of each row's patient in the patients table
+        if name not in self._tables:
+            columns = read_table(self.store, name)
+            positions = np.searchsorted(self.patient_id, columns["patient_id"])
+            self._tables[name] = (columns, positions)
+        return self._tables[name]
+
+    def zones(self, name):
+        ## A partitioned table's zone maps as arrays, one value per month (None if not partitioned).
+        ## Months without a date have no date range, so never overlap a window
+        if name not in self._zones:
+            zones = None
+            if is_partitioned(self.store, name):
+                maps = zone_maps(self.store, name)
+                zones = {
+                    "start": np.array([zone["start"] for zone in maps], dtype=np.int64),
+                    "end": np.array([zone["end"] for zone in maps], dtype=np.int64),
+                    "min_date": np.array([zone["min_date"] or "NaT" for zone in maps], dtype="datetime64[D]"),
+                    "max_date": np.array([zone["max_date"] or "NaT" for zone in maps], dtype="datetime64[D]"),
+                }
+                if all("min_code" in zone for zone in maps):
+                    zones["min_code"] = np.array([zone["min_code"] for zone in maps], dtype=np.int64)
+                    zones["max_code"] = np.array([zone["max_code"] for zone in maps], dtype=np.int64)
+            self._zones[name] = zones
+        return self._zones[name]
+
+    def partitions(self, name, lower=None, upper=None, codelist=None):
+        ## Row ranges of a partitioned table to scan for a query: the months whose zone map overlaps the
+        ## date window and the codelist's code range, with adjacent months merged. None if not partitioned.
+        ## A per-patient bound prunes by its earliest (lower) or latest (upper) date
+        zones = self.zones(name)
+        if zones is None:
+            return None
+
+        keep = ~np.isnat(zones["min_date"])
+        for bound, reduce, compare, edge in ((lower, np.min, operator.ge, "max_date"), (upper, np.max, operator.le, "min_date")):
+            if bound is None:
+                continue
+            if np.ndim(bound) > 0:
+                bound = bound[~np.isnat(bound)]
+                if len(bound) == 0:
+                    ## no patient has a bound, so no row can match
+                    return []
+                bound = reduce(bound)
+            keep &= compare(zones[edge], bound)
+
+        codes = codelist.load()[0] if codelist is not None else None
+        if codes is not None and len(codes) and codes.dtype.kind in "iu" and "min_code" in zones:
+            keep &= (zones["max_code"] >= codes.min()) & (zones["min_code"] <= codes.max())
+
+        ## merge runs of adjacent months into one range
+        starts, ends = zones["start"][keep], zones["end"][keep]
+        first = np.r_[True, starts[1:] != ends[:-1]]
+        last = np.r_[first[1:], True]
+        return list(zip(starts[first].tolist(), ends[last].tolist()))
+
+    def scanned(self, n):
+        self._record.rows_scanned += int(n)
+
+    def matched(self, n):
+        self._record.rows_matched += int(n)
+
+    ## Dates ----
+
+    def date(self, value):
+        ## Returns a datetime64 scalar, or a per-patient array when the date refers to another variable.
+        ## Expressions are parsed once (parse_date_expression is cached), and constant dates resolved once.
+        if value is None:
+            return None
+        if value in self._dates:
+            return self._dates[value]
+
+        reference, unit, n = parse_date_expression(str(value))
+        constant = reference == "index_date" or _ISO_DATE.match(reference)
+        if reference == "index_date":
+            date = self.index_date
+        elif constant:
+            date = np.datetime64(reference, "D")
+        elif reference in self.values and self.values[reference].dtype.kind == "M":
+            date = self.values[reference]
+        else:
+            raise ValueError(f"'{value}' is not a date or a date variable")
+
+        if unit == "day":
+            date = date + np.timedelta64(n, "D")
+        elif unit == "month":
+            date = add_months(date, n)
+        if constant:
+            self._dates[value] = date
+        return date
+
+    def window(self, on_or_before=None, on_or_after=None, between=None):
+        if between is not None:
+            on_or_after, on_or_before = between
+        return self.date(on_or_after), self.date(on_or_before)
+
+    @staticmethod
+    def aligned(bound, positions):
+        ## A per-patient bound, gathered to one value per row (via each row's patient position);
+        ## a constant bound is used as it is
+        if np.ndim(bound) == 0:
+            return bound
+        return bound[positions]
+
+    def compare(self, values, positions, bound, op):
+        ## values (one per row) compared with a date bound that is either a constant or per-patient,
+        ## in one vectorized pass. Rows whose patient has no bound (NaT) compare False
+        return op(values, self.aligned(bound, positions))
+
+    def in_window(self, dates, positions, lower, upper):
+        mask = ~np.isnat(dates)
+        if lower is not None:
+            mask &= self.compare(dates, positions, lower, operator.ge)
+        if upper is not None:
+            mask &= self.compare(dates, positions, upper, operator.le)
+        return mask
+
+    ## Reductions ----
+
+    @staticmethod
+    def pick(positions, which):
+        ## Rows are sorted by patient then date, so the first/last row of each run is the first/last match
+        if len(positions) == 0:
+            return np.zeros(0, dtype=bool)
+        change = positions[1:] != positions[:-1]
+        if which == "first":
+            return np.concatenate([[True], change])
+        return np.concatenate([change, [True]])
+
+    def reduce(self, rows, positions, returning, which, dates=None, codes=None, numeric_values=None, codelist=None):
+        matched = positions[rows]
+        self.matched(len(rows))
+
+        if returning == "binary_flag":
+            result = np.zeros(self.n, dtype=np.int8)
+            result[matched] = 1
+            return result
+        if returning == "number_of_matches_in_period":
+            return np.bincount(matched, minlength=self.n).astype(np.int64)
+
+        keep = self.pick(matched, which)
+        rows, matched = rows[keep], matched[keep]
+
+        if returning in ("date", "date_of_death"):
+            result = np.full(self.n, NAT)
+            result[matched] = dates[rows]
+        elif returning == "numeric_value":
+            result = np.zeros(self.n, dtype=np.float64)
+            result[matched] = np.nan_to_num(numeric_values[rows])
+        elif returning == "code":
+            result = np.zeros(self.n, dtype=np.int64)
+            result[matched] = codes[rows]
+        elif returning == "category":
+            list_codes, categories = codelist.load()
+            if categories is None:
+                raise ValueError("returning='category' needs a codelist with a category_column")
+            order = np.argsort(list_codes)
+            found = order[np.searchsorted(list_codes, codes[rows], sorter=order)]
+            result = np.full(self.n, "", dtype=categories.dtype)
+            result[matched] = categories[found]
+        else:
+            raise ValueError(f"unsupported returning='{returning}'")
+        return result
+
+    def events(self, table, codelist, returning="binary_flag", find_first_match_in_period=None,
+               find_last_match_in_period=None, on_or_before=None, on_or_after=None, between=None,
+               ignore_missing_values=False, date_format=None, return_expectations=None, match=None):
+        lower, upper = self.window(on_or_before, on_or_after, between)
+        table_columns, table_positions = self.table(table)
+        ranges = self.partitions(table, lower, upper, codelist)
+
+        scans = []
+        for start, end in ranges if ranges is not None else [(0, len(table_positions))]:
+            columns = {name: values[start:end] for name, values in table_columns.items()}
+            positions = table_positions[start:end]
+            dates = columns["date"]
+            self.scanned(len(dates))
+
+            mask = self.in_window(dates, positions, lower, upper)
+            if codelist is not None:
+                mask &= np.isin(columns["code"], codelist.load()[0])
+            if match is not None:
+                mask &= match(columns)
+            if ignore_missing_values:
+                numeric_values = columns["numeric_value"]
+                mask &= ~np.isnan(numeric_values) & (numeric_values != 0)
+            scans.append((columns, positions, np.flatnonzero(mask)))
+
+        if ranges is None:
+            columns, positions, rows = scans[0]
+        else:
+            ## partitions are in month order, so first/last matches need the rows back in patient then date order
+            columns, positions, rows = self.gather(table, scans, ordered=returning not in UNORDERED)
+
+        return self.reduce(
+            rows, positions, returning,
+            "first" if find_first_match_in_period else "last",
+            dates=columns["date"], codes=columns.get("code"), numeric_values=columns.get("numeric_value"), codelist=codelist,
+        )
+
+    @staticmethod
+    def gather(table, scans, ordered=True):
+        ## Matching rows from the scanned ranges, sorted by patient then date for reduce() if ordered.
+        ## Rows with the same patient and date are in the same month, so they keep their stored order
+        names = [name for name in ("date", "code", "numeric_value") if name in TABLES[table]]
+        positions = np.concatenate([np.zeros(0, dtype=np.int64)] + [p[rows] for _, p, rows in scans])
+        columns = {
+            name: np.concatenate([np.zeros(0, dtype=TABLES[table][name])] + [np.asarray(c[name])[rows] for c, _, rows in scans])
+            for name in names
+        }
+        if ordered:
+            order = np.lexsort((columns["date"], positions))
+            columns = {name: values[order] for name, values in columns.items()}
+            positions = positions[order]
+        return columns, positions, np.arange(len(positions))
+
+    ## Variables ----
+
+    def dependencies(self, spec):
+        ## Other variables this one refers to, by name, in expressions or date arguments
+        names = set()
+        if spec.function == "satisfying":
+            expressions = [spec.args[0] if spec.args else spec.kwargs["expression"]]
+        elif spec.function == "categorised_as":
+            expressions = [rule for rule in (spec.args[0] if spec.args else spec.kwargs["categories"]).values() if rule != "DEFAULT"]
+        else:
+            expressions = []
+        for expression in expressions:
+            names.update(node.id for node in ast.walk(parse_expression(expression)) if isinstance(node, ast.Name))
+        for value in list(spec.args) + list(spec.kwargs.values()):
+            for item in (value if isinstance(value, (list, tuple)) else [value]):
+                match = _DATE_EXPRESSION.match(item) if isinstance(item, str) else None
+                if match and match.group("reference") in self.specs:
+                    names.add(match.group("reference"))
+        return names - {spec.name}
+
+    def evaluate(self, spec):
+        ## Evaluate anything this variable refers to first, so each profile record only times its own work
+        if spec.name in self.values:
+            return self.values[spec.name]
+        for name in sorted(self.dependencies(spec)):
+            if name not in self.specs:
+                raise ValueError(f"{spec.name}: refers to '{name}', which is not a variable in the study definition")
+            self.evaluate(self.specs[name])
+
+        handler = getattr(self, f"_{spec.function}", None)
+        if handler is None:
+            raise ValueError(f"{spec.name}: patients.{spec.function} is not supported by the local extractor")
+
+        codelist = spec.backend_codelist(self.backend)
+        record = VariableProfile(
+            name=spec.name,
+            function=spec.function,
+            returning=spec.returning,
+            hidden=spec.hidden,
+            codelist_size=len(codelist) if codelist is not None else None,
+        )
+        with self.profiler.measure(record):
+            self._record = record
+            values = handler(*spec.args, **spec.kwargs)
+        self.values[spec.name] = values
+        return values
+
+    def _with_these_clinical_events(self, codelist, **kwargs):
+        return self.events("clinical_events", codelist, **kwargs)
+
+    def _with_these_medications(self, codelist, **kwargs):
+        return self.events("medications", codelist, **kwargs)
+
+    def _with_vaccination_record(self, tpp=None, emis=None, **kwargs):
+        ## TPP records vaccinations by target disease, EMIS as immunisation procedure codes
+        if self.backend == "tpp":
+            target = tpp["target_disease_matches"]
+            return self.events("vaccinations", None, match=lambda columns: columns["target_disease"] == target, **kwargs)
+        if self.backend == "emis":
+            return self.events("immunisations", emis["procedure_codes"], **kwargs)
+        raise ValueError(f"with_vaccination_record is not supported for backend '{self.backend}'")
+
+    def _died_from_any_cause(self, returning="binary_flag", on_or_before=None, on_or_after=None, between=None,
+                             date_format=None, return_expectations=None):
+        dates = self.patients["date_of_death"]
+        positions = np.arange(self.n)
+        self.scanned(self.n)
+        mask = self.in_window(dates, positions, *self.window(on_or_before, on_or_after, between))
+        return self.reduce(np.flatnonzero(mask), positions, returning, "last", dates=dates)
+
+    def _registered_with_one_practice_between(self, start_date, end_date, return_expectations=None):
+        columns, positions = self.table("registrations")
+        self.scanned(len(positions))
+        end = np.where(np.isnat(columns["end_date"]), OPEN_END, columns["end_date"])
+        mask = (
+            self.compare(columns["start_date"], positions, self.date(start_date), operator.le)
+            & self.compare(end, positions, self.date(end_date), operator.ge)
+        )
+        return self.reduce(np.flatnonzero(mask), positions, "binary_flag", "last")
+
+    def _registered_as_of(self, reference_date, return_expectations=None):
+        return self._registered_with_one_practice_between(reference_date, reference_date)
+
+    def _date_deregistered_from_all_supported_practices(self, on_or_before=None, on_or_after=None, between=None,
+                                                        date_format=None, return_expectations=None):
+        columns, positions = self.table("registrations")
+        self.scanned(len(positions))
+        end = columns["end_date"]
+
+        ## Latest end date per patient, unless any registration is still open (NaT sorts lowest as int64)
+        last_end = np.full(self.n, NAT).view(np.int64)
+        np.maximum.at(last_end, positions, np.asarray(end).view(np.int64))
+        last_end = last_end.view("datetime64[D]")
+        last_end[np.unique(positions[np.isnat(end)])] = NAT
+
+        patients = np.arange(self.n)
+        mask = self.in_window(last_end, patients, *self.window(on_or_before, on_or_after, between))
+        return self.reduce(np.flatnonzero(mask), patients, "date", "last", dates=last_end)
+
+    def _age_as_of(self, reference_date, return_expectations=None):
+        reference = self.date(reference_date)
+        dob = self.patients["date_of_birth"]
+        self.scanned(self.n)
+        known = ~np.isnat(dob)
+        years = np.zeros(self.n, dtype=np.int64)
+        years[known] = (
+            np.asarray(reference).astype("datetime64[Y]").astype(np.int64)
+            - dob[known].astype("datetime64[Y]").astype(np.int64)
+        )
+        birthday = add_months(dob[known], years[known] * 12)
+        years[known] -= birthday > (reference if np.ndim(reference) == 0 else reference[known])
+        self.matched(known.sum())
+        return years
+
+    def _sex(self, return_expectations=None):
+        self.scanned(self.n)
+        sex = np.asarray(self.patients["sex"])
+        self.matched((sex != "").sum())
+        return sex
+
+    def _registered_practice_as_of(self, date, returning="pseudo_id", return_expectations=None):
+        if returning != "pseudo_id":
+            raise ValueError(f"registered_practice_as_of: unsupported returning='{returning}'")
+        columns, positions = self.table("registrations")
+        self.scanned(len(positions))
+        reference = self.aligned(self.date(date), positions)
+        end = np.where(np.isnat(columns["end_date"]), OPEN_END, columns["end_date"])
+        mask = (columns["start_date"] <= reference) & (end >= reference)
+        return self.reduce(np.flatnonzero(mask), positions, "code", "last", codes=columns["practice_pseudo_id"])
+
+    def _address_as_of(self, date, returning="index_of_multiple_deprivation", round_to_nearest=None,
+                       return_expectations=None):
+        if returning != "index_of_multiple_deprivation":
+            raise ValueError(f"address_as_of: unsupported returning='{returning}'")
+        columns, positions = self.table("addresses")
+        self.scanned(len(positions))
+        reference = self.aligned(self.date(date), positions)
+        end = np.where(np.isnat(columns["end_date"]), OPEN_END, columns["end_date"])
+        mask = (columns["start_date"] <= reference) & (end >= reference)
+        imd = np.asarray(columns["index_of_multiple_deprivation"])
+        if round_to_nearest:
+            imd = (np.round(imd / round_to_nearest) * round_to_nearest).astype(np.int64)
+        result = self.reduce(np.flatnonzero(mask), positions, "code", "last", codes=imd)
+        found = np.zeros(self.n, dtype=bool)
+        found[positions[mask]] = True
+        result[~found] = -1
+        return result
+
+    def _all(self):
+        return np.ones(self.n, dtype=np.int8)
+
+    def _satisfying(self, expression, return_expectations=None):
+        self.scanned(self.n)
+        result = truthy(self.expression(parse_expression(expression))).astype(np.int8)
+        self.matched(result.sum())
+        return result
+
+    def _categorised_as(self, categories, return_expectations=None):
+        self.scanned(self.n)
+        default = next((label for label, rule in categories.items() if rule == "DEFAULT"), "")
+        width = max(len(str(label)) for label in categories)
+        result = np.full(self.n, str(default), dtype=f"<U{width}")
+        assigned = np.zeros(self.n, dtype=bool)
+        for label, rule in categories.items():
+            if rule == "DEFAULT":
+                continue
+            mask = truthy(self.expression(parse_expression(rule))) & ~assigned
+            result[mask] = str(label)
+            assigned |= mask
+        self.matched(assigned.sum())
+        return result
+
+    def expression(self, node):
+        if isinstance(node, ast.BoolOp):
+            combine = np.logical_and if isinstance(node.op, ast.And) else np.logical_or
+            values = [truthy(self.expression(value)) for value in node.values]
+            result = values[0]
+            for value in values[1:]:
+                result = combine(result, value)
+            return result
+        if isinstance(node, ast.UnaryOp):
+            value = self.expression(node.operand)
+            if isinstance(node.op, ast.Not):
+                return ~truthy(value)
+            if isinstance(node.op, ast.USub):
+                return -value
+        if isinstance(node, ast.Compare):
+            left = self.expression(node.left)
+            result = None
+            for op, comparator in zip(node.ops, node.comparators):
+                right = self.expression(comparator)
+                step = _COMPARISONS[type(op)](left, right)
+                result = step if result is None else result & step
+                left = right
+            return result
+        if isinstance(node, ast.BinOp):
+            left, right = self.expression(node.left), self.expression(node.right)
+            if isinstance(node.op, ast.Add):
+                return left + right
+            if isinstance(node.op, ast.Sub):
+                return left - right
+            if isinstance(node.op, ast.Mult):
+                return left * right
+            if isinstance(node.op, ast.Div):
+                ## integer division for integers, as in the SQL the expression was written for
+                if np.asarray(left).dtype.kind in "iu" and np.asarray(right).dtype.kind in "iu":
+                    return left // right
+                return left / right
+        if isinstance(node, ast.Name):
+            if node.id not in self.values:
+                raise ValueError(f"expression refers to '{node.id}', which has not been evaluated")
+            return self.values[node.id]
+        if isinstance(node, ast.Constant):
+            return node.value
+        raise ValueError(f"unsupported expression {ast.dump(node)[:60]}")
+
+    ## Cohort ----
+
+    def extract(self):
+        self.specs = {spec.name: spec for spec in self.study.walk()}
+        for spec in self.study.walk():
+            self.evaluate(spec)
+
+        with self.profiler.measure(VariableProfile(name="population_filter", kind="stage")) as record:
+            population = self.values["population"].astype(bool)
+            record.rows_scanned, record.rows_matched = self.n, int(population.sum())
+            cohort = {"patient_id": self.patient_id[population]}
+            for name in self.study.output_columns:
+                cohort[name] = self.values[name][population]
+        return cohort
+
+
+# --- OUTPUT ---
+
+def format_column(values, date_format=None):
+    ## Render one column as strings, with missing dates as empty strings (as cohortextractor does)
+    if values.dtype.kind == "M":
+        text = np.datetime_as_string(values.astype(f"datetime64[{DATE_UNITS[date_format]}]"))
+        return np.where(np.isnat(values), "", text)
+    return values.astype(str)
+
+
+def write_cohort(cohort, path, study, chunk_size=100_000, sketch=None, date_offsets=None):
+    ## Chunks are also fed to the sketch (lib/sketches.py), if given, so it is filled in as the file is written.
+    ## With date_offsets (a DateOffsets), date columns are written as int16 day offsets instead of ISO dates.
+    date_formats = {variable.name: variable.kwargs.get("date_format") for variable in study.variables}
+    names = list(cohort)
+    n = len(cohort["patient_id"])
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(names)
+        for start in range(0, n, chunk_size):
+            chunk = {name: cohort[name][start:start + chunk_size] for name in names}
+            if sketch is not None:
+                sketch.update(chunk)
+            columns = []
+            for name in names:
+                if date_offsets is not None and chunk[name].dtype.kind == "M":
+                    columns.append(date_offsets.format(date_offsets.encode(chunk[name], date_formats.get(name))).tolist())
+                else:
+                    columns.append(format_column(chunk[name], date_formats.get(name)).tolist())
+            writer.writerows(zip(*columns))
+
+
+def output_path(output_dir, study_definition):
+    ## Same naming as cohortextractor: study_definition_flow_chart -> input_flow_chart.csv
+    suffix = study_definition[len("study_definition"):]
+    return Path(output_dir) / f"input{suffix}.csv"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Extract a cohort from a local event store")
+    parser.add_argument("--study-definition", default="study_definition")
+    parser.add_argument("--store", required=True, help="local event store directory")
+    parser.add_argument("--analysis-dir", default="analysis")
+    parser.add_argument("--output-dir", default="output")
+    parser.add_argument("--backend", default="tpp")
+    parser.add_argument("--profile", action="store_true", help="write per-variable profile sidecars")
+    parser.add_argument("--bitmap-index", action="store_true", help="write a bitmap index of the covariates")
+    parser.add_argument("--date-offsets", action="store_true", help="write dates as int16 days from index_date")
+    args = parser.parse_args(argv)
+
+    study = load_study_definition(args.study_definition, args.analysis_dir)
+    profiler = ExtractionProfiler() if args.profile else NullProfiler()
+    extractor = LocalExtractor(study, args.store, backend=args.backend, profiler=profiler)
+
+    cohort = extractor.extract()
+    path = output_path(args.output_dir, args.study_definition)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    sketch = CohortSketch.for_study(study)
+    date_offsets = DateOffsets(study.index_date) if args.date_offsets else None
+    with profiler.measure(VariableProfile(name="write_cohort", kind="stage")) as record:
+        write_cohort(cohort, path, study, sketch=sketch, date_offsets=date_offsets)
+        record.rows_matched = len(cohort["patient_id"])
+
+    ## The sidecar tells readers how the dates are encoded, so remove any left from an earlier run
+    if date_offsets is not None:
+        date_offsets.write(date_offsets_path(path), [name for name in cohort if cohort[name].dtype.kind == "M"], path)
+    elif date_offsets_path(path).exists():
+        date_offsets_path(path).unlink()
+    sketch.write(
+        sketch_path(path), cohort=path.name, cohort_md5=file_md5(path),
+        study_definition=args.study_definition, backend=args.backend,
+    )
+
+    if args.bitmap_index:
+        with profiler.measure(VariableProfile(name="bitmap_index", kind="stage")):
+            BitmapIndex.build(cohort, study).save(index_path(path))
+
+    if args.profile:
+        profiler.close()
+        profiler.write(
+            path,
+            study_definition=args.study_definition,
+            backend=args.backend,
+            store=args.store,
+            n_patients=extractor.n,
+            population_size=len(cohort["patient_id"]),
+        )
+
+
+if __name__ == "__main__":
+    main()
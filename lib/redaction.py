@@ -0,0 +1,39 @@
+######################################
+
+# This script:
+# - is a python port of redactor() and redactor2() in lib/redaction_functions.R, for the
+#   python tools in lib/ that report counts from summaries rather than row-level data
+# - applies the same rules: a frequency is redacted if it is between 1 and the threshold, and if
+#   the redacted frequencies still sum to no more than the threshold, the next smallest is too
+
+######################################
+
+
+# --- REDACTION ---
+
+def redactor(n, threshold):
+    ## Boolean list, True where the frequency in n should be redacted
+    n = [int(value) for value in n]
+    leq_threshold = [1 <= value <= threshold for value in n]
+    n_sum = sum(n)
+
+    ## redact if n is less than or equal to redaction threshold
+    redact = list(leq_threshold)
+
+    ## also redact next smallest n if sum of redacted n is still less than or equal to threshold
+    if sum(value for value, small in zip(n, leq_threshold) if small) <= threshold and any(leq_threshold):
+        candidates = [n_sum + 1 if small else value for value, small in zip(n, leq_threshold)]
+        redact[candidates.index(min(candidates))] = True
+
+    return redact
+
+
+def redactor2(n, threshold=5, x=None):
+    ## n with redacted frequencies replaced by None, or if x is given, x redacted based on n
+    if not any(value is not None for value in n):
+        raise ValueError("n must be non-missing")
+    if x is None:
+        x = n
+    if len(x) != len(n):
+        raise ValueError("x must be same length as n")
+    return [None if redact else value for value, redact in zip(x, redactor(n, threshold))]
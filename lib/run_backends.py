@@ -0,0 +1,119 @@
+######################################
+
+# This script:
+# - extracts the study against local stand-ins for both backends at once: a TPP-shaped and an
+#   EMIS-shaped synthetic event store (see lib/synthetic_store.py), generated if missing
+# - runs each backend in its own process, concurrently, writing to per-backend directories
+#   (output/backends/tpp/input.csv, output/backends/emis/input.csv, with profile and sketch sidecars)
+# - prints wall time, peak RSS and per-variable timings side by side, and writes them to
+#   output/backends/summary.json
+#
+# Usage:
+#   python lib/run_backends.py --patients 100000
+#   python lib/run_backends.py --backends emis --study-definition study_definition_flow_chart
+
+######################################
+
+
+# --- IMPORT STATEMENTS ---
+
+import argparse
+import json
+import resource
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from local_extraction import main as extract
+from synthetic_store import generate_store
+
+
+ROOT = Path(__file__).resolve().parent.parent
+
+BACKENDS = ("tpp", "emis")
+
+
+# --- RUNNING ---
+
+def run_backend(backend, store, output_dir, study_definition, n_patients, seed):
+    ## Runs in a worker process: generate the stand-in store if needed, then extract with the profiler on
+    store = Path(store)
+    result = {"backend": backend, "store": str(store)}
+    if not (store / "patients" / "patient_id.npy").exists():
+        start = time.perf_counter()
+        generate_store(store, n_patients, seed=seed, backend=backend)
+        result["generate_store"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    extract([
+        "--study-definition", study_definition,
+        "--store", str(store),
+        "--analysis-dir", str(ROOT / "analysis"),
+        "--output-dir", str(output_dir),
+        "--backend", backend,
+        "--profile",
+    ])
+    result["extraction"] = time.perf_counter() - start
+    result["peak_rss"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+
+    suffix = study_definition[len("study_definition"):]
+    profile = json.loads((Path(output_dir) / f"input{suffix}_profile.json").read_text())
+    result["population_size"] = profile["population_size"]
+    result["variables"] = {record["name"]: record["wall_time"] for record in profile["records"]}
+    return result
+
+
+def run_backends(backends, stores, output, study_definition, n_patients, seed=0):
+    ## One single-worker pool per backend, so each runs in a fresh process (and peak RSS is per backend)
+    pools = {backend: ProcessPoolExecutor(max_workers=1) for backend in backends}
+    try:
+        futures = {
+            backend: pool.submit(run_backend, backend, Path(stores) / backend, Path(output) / backend,
+                                 study_definition, n_patients, seed)
+            for backend, pool in pools.items()
+        }
+        return {backend: future.result() for backend, future in futures.items()}
+    finally:
+        for pool in pools.values():
+            pool.shutdown()
+
+
+# --- REPORT ---
+
+def print_results(results):
+    backends = list(results)
+    print(f"{'':<45}" + "".join(f"{backend:>14}" for backend in backends))
+    for key, label, scale in (("extraction", "extraction (s)", 1), ("peak_rss", "peak RSS (MB)", 2**20),
+                              ("population_size", "population", 1)):
+        print(f"{label:<45}" + "".join(f"{results[backend][key] / scale:>14.1f}" for backend in backends))
+    print()
+    names = list(dict.fromkeys(name for result in results.values() for name in result["variables"]))
+    for name in names:
+        times = [results[backend]["variables"].get(name) for backend in backends]
+        print(f"{name:<45}" + "".join(f"{time_:>14.3f}" if time_ is not None else f"{'-':>14}" for time_ in times))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Extract the study against TPP and EMIS stand-in stores concurrently")
+    parser.add_argument("--backends", nargs="+", choices=BACKENDS, default=list(BACKENDS))
+    parser.add_argument("--patients", type=int, default=100_000, help="patients per stand-in store, if generated")
+    parser.add_argument("--stores", default=str(ROOT / "output" / "backends" / "stores"))
+    parser.add_argument("--output", default=str(ROOT / "output" / "backends"))
+    parser.add_argument("--study-definition", default="study_definition")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    start = time.perf_counter()
+    results = run_backends(args.backends, args.stores, args.output, args.study_definition, args.patients, args.seed)
+    total = time.perf_counter() - start
+
+    print_results(results)
+    print(f"\nall backends: {total:.1f}s")
+    summary = {"study_definition": args.study_definition, "wall_time": total, "backends": results}
+    Path(args.output).mkdir(parents=True, exist_ok=True)
+    (Path(args.output) / "summary.json").write_text(json.dumps(summary, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,446 @@
+######################################
+
+# This script:
+# - runs the actions in project.yaml locally, in dependency order, with independent actions
+#   (eg data_properties, data_summaries and model_final) running concurrently
+# - skips actions whose command, scripts and inputs are unchanged since a cached run, and
+#   restores their outputs from a content-addressed store (.pipeline_cache)
+# - records wall time, CPU time, peak RSS and input/output bytes for each action
+# - writes a telemetry table (metadata/telemetry.csv) and flags regressions against a stored
+#   baseline (metadata/telemetry_baseline.csv)
+#
+# Usage:
+#   python lib/run_pipeline.py                              # run every action
+#   python lib/run_pipeline.py model_final strata_summary   # run these actions (and what they need)
+#   python lib/run_pipeline.py --store output/event_store   # extract with lib/local_extraction.py
+#   python lib/run_pipeline.py --save-baseline              # store this run as the baseline
+#   python lib/run_pipeline.py --no-cache --jobs 1          # rerun everything, one action at a time
+#
+# Actions run on the host, not in the OpenSAFELY docker images: r:latest runs with Rscript,
+# python:latest with this python, and cohortextractor:latest with the cohortextractor command
+# (or the local extractor if --store is given). Paths under /workspace refer to the repo root.
+#
+# An action's cache key is a hash of its run command, the contents of the scripts it runs (and
+# the lib/ files R scripts source, or the local modules python scripts import), and the contents of
+# the outputs of the actions it needs. Cohort extraction, and python scripts that load a study
+# definition, also hash the study definitions and codelists; extraction with --store hashes the event store.
+
+######################################
+
+
+# --- IMPORT STATEMENTS ---
+
+import argparse
+import ast
+import csv
+import glob
+import hashlib
+import json
+import os
+import re
+import shlex
+import shutil
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import asdict, dataclass, fields
+from pathlib import Path
+from typing import Optional
+
+import yaml
+
+
+ROOT = Path(__file__).resolve().parent.parent
+
+
+# --- PROJECT ---
+
+@dataclass
+class Action:
+    name: str
+    run: str
+    needs: list
+    outputs: list  # output file patterns, across all privacy levels
+
+
+def load_project(path=ROOT / "project.yaml"):
+    with open(path) as f:
+        project = yaml.safe_load(f)
+    actions = {}
+    for name, action in project["actions"].items():
+        outputs = [pattern for level in action.get("outputs", {}).values() for pattern in level.values()]
+        actions[name] = Action(name=name, run=action["run"], needs=action.get("needs", []), outputs=outputs)
+    return actions
+
+
+def execution_order(actions, targets=None):
+    ## Depth-first topological order over `needs`, restricted to the targets and what they need
+    order = []
+    seen = set()
+
+    def visit(name, path=()):
+        if name in path:
+            raise ValueError(f"dependency cycle: {' -> '.join(path + (name,))}")
+        if name in seen:
+            return
+        if name not in actions:
+            raise ValueError(f"unknown action '{name}'")
+        for need in actions[name].needs:
+            visit(need, path + (name,))
+        seen.add(name)
+        order.append(name)
+
+    for name in targets or actions:
+        visit(name)
+    return order
+
+
+def command(action, store=None):
+    ## Translate the docker image invocation in `run:` to a command on this machine
+    image, *args = shlex.split(action.run)
+    args = [arg.replace("/workspace", str(ROOT)) for arg in args]
+    image = image.split(":")[0]
+    if image == "cohortextractor":
+        if store is not None:
+            study_definition = args[args.index("--study-definition") + 1]
+            return [sys.executable, str(ROOT / "lib" / "local_extraction.py"), "--study-definition", study_definition,
+                    "--store", str(store), "--output-dir", str(ROOT / "output")]
+        return ["cohortextractor"] + args
+    if image == "r":
+        return ["Rscript"] + args
+    if image == "python":
+        return [sys.executable] + args
+    raise ValueError(f"{action.name}: don't know how to run '{image}' locally")
+
+
+def output_files(patterns):
+    return sorted({path for pattern in patterns for path in glob.glob(str(ROOT / pattern))})
+
+
+def total_bytes(paths):
+    return sum(os.path.getsize(path) for path in paths if os.path.isfile(path))
+
+
+# --- CACHE ---
+
+_SCRIPT = re.compile(r"[\w./-]+\.(?:R|Rmd|py)\b")
+_SOURCED = re.compile(r'here\(\s*"lib"\s*,\s*"([\w.-]+)"\s*\)')
+
+
+class Digests:
+
+    ## sha256 of file contents, remembered by (size, mtime) so each input is read once per run
+
+    def __init__(self):
+        self._known = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, path):
+        stat = os.stat(path)
+        signature = (stat.st_size, stat.st_mtime_ns)
+        with self._lock:
+            known = self._known.get(path)
+        if known is not None and known[0] == signature:
+            return known[1]
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(2**20), b""):
+                digest.update(block)
+        with self._lock:
+            self._known[path] = (signature, digest.hexdigest())
+        return digest.hexdigest()
+
+
+def python_imports(path, seen=None):
+    ## Local modules a python script imports, directly or through other local modules. The tools in lib/
+    ## import each other by module name, so a module is local if it is next to the script that imports it
+    seen = set() if seen is None else seen
+    tree = ast.parse(Path(path).read_text(), filename=str(path))
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            names = [alias.name for alias in node.names]
+        elif isinstance(node, ast.ImportFrom) and node.module and not node.level:
+            names = [node.module]
+        else:
+            continue
+        for name in names:
+            module = Path(path).parent / f"{name.split('.')[0]}.py"
+            if module.is_file() and module not in seen:
+                seen.add(module)
+                python_imports(module, seen)
+    return seen
+
+
+def study_sources(study_definition="study_definition*"):
+    ## The study definition(s) and the codelists they read
+    sources = set((ROOT / "analysis").glob(f"{study_definition}.py"))
+    sources.add(ROOT / "analysis" / "codelists.py")
+    sources.update((ROOT / "codelists").glob("*.csv"))
+    return sources
+
+
+def action_sources(action, store=None):
+    ## Files that define what an action does, as opposed to the data it reads
+    image = action.run.split(":")[0]
+    sources = set()
+    if image == "cohortextractor":
+        args = shlex.split(action.run)
+        sources.update(study_sources(args[args.index("--study-definition") + 1]))
+        if store is not None:
+            sources.update((ROOT / "lib").glob("*.py"))
+    for script in _SCRIPT.findall(action.run):
+        path = ROOT / script.replace("/workspace/", "")
+        if path.is_file():
+            sources.add(path)
+            ## R scripts and markdown source helpers with here::here("lib", ...)
+            if path.suffix in (".R", ".Rmd"):
+                sources.update(ROOT / "lib" / name for name in _SOURCED.findall(path.read_text()))
+            ## python scripts import local modules; those that load a study definition (through
+            ## lib/study_spec.py) also depend on the study definitions and codelists
+            if path.suffix == ".py":
+                modules = python_imports(path)
+                sources.update(modules)
+                if any(module.name == "study_spec.py" for module in modules | {path}):
+                    sources.update(study_sources())
+    return sorted(path for path in sources if path.is_file())
+
+
+def action_key(action, actions, digests, store=None):
+    key = hashlib.sha256(action.run.encode())
+    for path in action_sources(action, store):
+        key.update(f"{Path(path).relative_to(ROOT)}:{digests(str(path))}\n".encode())
+    for need in action.needs:
+        for path in output_files(actions[need].outputs):
+            key.update(f"{need}:{Path(path).relative_to(ROOT)}:{digests(path)}\n".encode())
+    if store is not None and action.run.startswith("cohortextractor"):
+        ## Event stores are large: identify them by file sizes and modification times, not contents
+        for path in sorted(store.rglob("*.npy")):
+            stat = path.stat()
+            key.update(f"store:{path.relative_to(store)}:{stat.st_size}:{stat.st_mtime_ns}\n".encode())
+    return key.hexdigest()
+
+
+class ActionCache:
+
+    ## Outputs are kept once per content hash under blobs/, and each cached run is a manifest
+    ## (actions/<key>.json) mapping output paths to content hashes
+
+    def __init__(self, root=ROOT / ".pipeline_cache", digests=None):
+        self.root = Path(root)
+        self.digests = digests or Digests()
+
+    def _blob(self, digest):
+        return self.root / "blobs" / digest[:2] / digest
+
+    def _manifest(self, key):
+        return self.root / "actions" / f"{key}.json"
+
+    def lookup(self, key):
+        path = self._manifest(key)
+        if not path.exists():
+            return None
+        manifest = json.loads(path.read_text())
+        if not all(self._blob(digest).exists() for digest in manifest["outputs"].values()):
+            return None
+        return manifest
+
+    def restore(self, manifest):
+        ## Copy back only the outputs that are missing or differ from the cached version
+        for relative, digest in manifest["outputs"].items():
+            path = ROOT / relative
+            if path.exists() and self.digests(str(path)) == digest:
+                continue
+            path.parent.mkdir(parents=True, exist_ok=True)
+            shutil.copyfile(self._blob(digest), path)
+        return [str(ROOT / relative) for relative in manifest["outputs"]]
+
+    def save(self, key, action):
+        outputs = {}
+        for path in output_files(action.outputs):
+            if not os.path.isfile(path):
+                continue
+            digest = self.digests(path)
+            blob = self._blob(digest)
+            if not blob.exists():
+                blob.parent.mkdir(parents=True, exist_ok=True)
+                partial = blob.with_suffix(f".{threading.get_ident()}.tmp")
+                shutil.copyfile(path, partial)
+                os.replace(partial, blob)
+            outputs[str(Path(path).relative_to(ROOT))] = digest
+        manifest = self._manifest(key)
+        manifest.parent.mkdir(parents=True, exist_ok=True)
+        manifest.write_text(json.dumps({"action": action.name, "run": action.run, "outputs": outputs}, indent=2))
+
+
+# --- TELEMETRY ---
+
+@dataclass
+class Telemetry:
+    action: str
+    status: str = "not run"
+    returncode: Optional[int] = None
+    wall_time: float = 0.0
+    cpu_time: float = 0.0
+    peak_rss: int = 0
+    input_bytes: int = 0
+    output_bytes: int = 0
+    block_reads: int = 0
+    block_writes: int = 0
+    regressions: str = ""
+
+
+METRICS = ("wall_time", "cpu_time", "peak_rss", "output_bytes")
+
+
+def run_action(action, actions, store=None, log_dir=None):
+    record = Telemetry(action=action.name)
+    log_dir = Path(log_dir) if log_dir is not None else ROOT / "metadata"
+    inputs = output_files(pattern for need in action.needs for pattern in actions[need].outputs)
+    record.input_bytes = total_bytes(inputs)
+
+    log_dir.mkdir(parents=True, exist_ok=True)
+    with open(log_dir / f"{action.name}.log", "w") as log:
+        start = time.perf_counter()
+        try:
+            process = subprocess.Popen(command(action, store), cwd=ROOT, stdout=log, stderr=subprocess.STDOUT)
+        except FileNotFoundError as error:
+            log.write(f"{error}\n")
+            record.status = "failed"
+            return record
+        ## wait4 gives the resource usage of this child alone, unlike getrusage(RUSAGE_CHILDREN)
+        _, status, usage = os.wait4(process.pid, 0)
+        record.wall_time = time.perf_counter() - start
+
+    process.returncode = os.waitstatus_to_exitcode(status) if hasattr(os, "waitstatus_to_exitcode") else status >> 8
+    record.returncode = process.returncode
+    record.status = "succeeded" if process.returncode == 0 else "failed"
+    record.cpu_time = usage.ru_utime + usage.ru_stime
+    record.peak_rss = usage.ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+    record.block_reads = usage.ru_inblock
+    record.block_writes = usage.ru_oublock
+    record.output_bytes = total_bytes(output_files(action.outputs))
+    return record
+
+
+def read_telemetry(path):
+    with open(path, newline="") as f:
+        return {row["action"]: row for row in csv.DictReader(f)}
+
+
+def write_telemetry(records, path):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=[field.name for field in fields(Telemetry)])
+        writer.writeheader()
+        for record in records:
+            writer.writerow(asdict(record))
+
+
+def flag_regressions(records, baseline, tolerance):
+    ## A metric regresses if it is more than `tolerance` (a proportion) above the baseline
+    for record in records:
+        previous = baseline.get(record.action)
+        if record.status != "succeeded" or previous is None or previous["status"] != "succeeded":
+            continue
+        flags = []
+        for metric in METRICS:
+            before, after = float(previous[metric]), float(getattr(record, metric))
+            if before > 0 and after > before * (1 + tolerance):
+                flags.append(f"{metric}(+{(after / before - 1):.0%})")
+        record.regressions = ";".join(flags)
+    return [record for record in records if record.regressions]
+
+
+def execute(action, actions, store=None, cache=None):
+    ## Restore a cached run if the action's key is unchanged, otherwise run it (and cache the result)
+    if cache is None:
+        return run_action(action, actions, store=store)
+    start = time.perf_counter()
+    key = action_key(action, actions, cache.digests, store)
+    manifest = cache.lookup(key)
+    if manifest is not None:
+        record = Telemetry(action=action.name, status="cached")
+        record.output_bytes = total_bytes(cache.restore(manifest))
+        record.wall_time = time.perf_counter() - start
+        return record
+    record = run_action(action, actions, store=store)
+    if record.status == "succeeded":
+        cache.save(key, action)
+    return record
+
+
+def run_actions(actions, order, store=None, cache=None, jobs=None):
+    ## Start each action as soon as everything it needs has finished; an action whose needs
+    ## failed is skipped. Records are returned in `order`, whatever order the actions ran in.
+    records = {}
+    failed = set()
+    pending = list(order)
+    running = {}
+    with ThreadPoolExecutor(max_workers=jobs or os.cpu_count()) as pool:
+        while pending or running:
+            for name in list(pending):
+                needs = actions[name].needs
+                if failed.intersection(needs):
+                    records[name] = Telemetry(action=name, status="skipped")
+                    failed.add(name)
+                    pending.remove(name)
+                elif all(need in records for need in needs):
+                    print(f"running {name}", flush=True)
+                    running[pool.submit(execute, actions[name], actions, store, cache)] = name
+                    pending.remove(name)
+            if not running:
+                continue
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                records[name] = record = future.result()
+                if record.status == "cached":
+                    print(f"{name} unchanged; restored outputs from cache", flush=True)
+                elif record.status != "succeeded":
+                    failed.add(name)
+                    print(f"{name} failed; see metadata/{name}.log", flush=True)
+    return [records[name] for name in order], failed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run project.yaml actions locally and record telemetry")
+    parser.add_argument("actions", nargs="*", help="actions to run (default: all), with the actions they need")
+    parser.add_argument("--store", help="local event store; extract with lib/local_extraction.py instead of cohortextractor")
+    parser.add_argument("--telemetry", default=str(ROOT / "metadata" / "telemetry.csv"))
+    parser.add_argument("--baseline", default=str(ROOT / "metadata" / "telemetry_baseline.csv"))
+    parser.add_argument("--save-baseline", action="store_true", help="store this run as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed increase over baseline (default 0.2)")
+    parser.add_argument("--fail-on-regression", action="store_true")
+    parser.add_argument("--jobs", type=int, help="actions to run at once (default: number of CPUs)")
+    parser.add_argument("--no-cache", action="store_true", help="run every action, even if unchanged")
+    parser.add_argument("--cache-dir", default=str(ROOT / ".pipeline_cache"))
+    args = parser.parse_args(argv)
+
+    actions = load_project()
+    store = Path(args.store).resolve() if args.store else None
+    cache = None if args.no_cache else ActionCache(args.cache_dir)
+    records, failed = run_actions(actions, execution_order(actions, args.actions), store=store, cache=cache, jobs=args.jobs)
+
+    regressions = []
+    if os.path.exists(args.baseline):
+        regressions = flag_regressions(records, read_telemetry(args.baseline), args.tolerance)
+
+    write_telemetry(records, Path(args.telemetry))
+    if args.save_baseline:
+        write_telemetry(records, Path(args.baseline))
+
+    for record in records:
+        print(
+            f"{record.action:<45} {record.status:<10} wall {record.wall_time:8.1f}s  cpu {record.cpu_time:8.1f}s  "
+            f"rss {record.peak_rss / 2**20:8.1f}MB  in {record.input_bytes / 2**20:8.1f}MB  "
+            f"out {record.output_bytes / 2**20:8.1f}MB  {record.regressions}"
+        )
+
+    if failed or (regressions and args.fail_on_regression):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,391 @@
+######################################
+
+# This script:
+# - keeps per-column streaming summaries (sketches) of an extracted cohort, updated one chunk at
+#   a time, so data-property reports never need the row-level file loaded whole:
+#   * missing counts, and min/max for numeric and date columns
+#   * t-digest quantiles for age and bmi
+#   * exact category counts for category and binary flag columns (eg sex, ethnicity, imd)
+#   * HyperLogLog distinct counts for id columns (eg practice_id_at_start)
+# - is filled in by lib/local_extraction.py as it writes the cohort (input.csv -> input_sketch.json),
+#   or by streaming an existing cohort file through this script
+# - writes the sketches as JSON, and a redacted text report (see lib/redaction.py)
+#
+# Usage:
+#   python lib/sketches.py output/input.csv --output-dir output/data_properties
+#
+# Missing values follow 00_process_data.R: empty strings, missing dates, and zeros in numeric
+# columns other than ids.
+
+######################################
+
+
+# --- IMPORT STATEMENTS ---
+
+import argparse
+import base64
+import csv
+import json
+import re
+from collections import Counter
+from pathlib import Path
+
+import numpy as np
+
+from date_offsets import DateOffsets, file_md5, read_date_offsets
+from redaction import redactor
+from study_spec import load_study_definition
+
+
+ROOT = Path(__file__).resolve().parent.parent
+
+QUANTILE_COLUMNS = ("age", "bmi")
+QUANTILES = (0.01, 0.1, 0.25, 0.5, 0.75, 0.9, 0.99)
+
+_KINDS = {
+    "date": "date",
+    "date_of_death": "date",
+    "category": "category",
+    "binary_flag": "flag",
+    "pseudo_id": "id",
+}
+
+
+# --- T-DIGEST ---
+
+class TDigest:
+
+    ## Merging t-digest: centroids (mean, weight) that are small near the tails and large in the
+    ## middle, so extreme quantiles stay accurate. Each update sorts the new values in with the
+    ## existing centroids and merges neighbours that share a bucket of the k1 scale function.
+
+    def __init__(self, compression=200):
+        self.compression = compression
+        self.means = np.empty(0)
+        self.weights = np.empty(0)
+        self.min = np.inf
+        self.max = -np.inf
+
+    @property
+    def count(self):
+        return float(self.weights.sum())
+
+    def update(self, values):
+        values = np.asarray(values, dtype=float)
+        values = values[~np.isnan(values)]
+        if len(values):
+            self.min = min(self.min, float(values.min()))
+            self.max = max(self.max, float(values.max()))
+            self._merge(np.concatenate([self.means, values]), np.concatenate([self.weights, np.ones(len(values))]))
+        return self
+
+    def merge(self, other):
+        if other.count:
+            self.min = min(self.min, other.min)
+            self.max = max(self.max, other.max)
+            self._merge(np.concatenate([self.means, other.means]), np.concatenate([self.weights, other.weights]))
+        return self
+
+    def _merge(self, means, weights):
+        order = np.argsort(means, kind="stable")
+        means, weights = means[order], weights[order]
+        cumulative = np.cumsum(weights)
+        ## quantile at each centroid's centre, mapped to k1 = compression/(2 pi) * asin(2q - 1)
+        q = (cumulative - weights / 2) / cumulative[-1]
+        k = np.floor(self.compression / (2 * np.pi) * np.arcsin(2 * q - 1))
+        starts = np.flatnonzero(np.r_[True, k[1:] != k[:-1]])
+        self.weights = np.add.reduceat(weights, starts)
+        self.means = np.add.reduceat(means * weights, starts) / self.weights
+
+    def quantile(self, q):
+        if not self.count:
+            return None
+        centres = np.cumsum(self.weights) - self.weights / 2
+        positions = np.r_[0, centres, self.count]
+        values = np.r_[self.min, self.means, self.max]
+        return float(np.interp(q * self.count, positions, values))
+
+    def to_dict(self):
+        return {
+            "compression": self.compression,
+            "min": self.min if self.count else None,
+            "max": self.max if self.count else None,
+            "means": self.means.tolist(),
+            "weights": self.weights.tolist(),
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        digest = cls(data["compression"])
+        digest.means = np.array(data["means"], dtype=float)
+        digest.weights = np.array(data["weights"], dtype=float)
+        if digest.count:
+            digest.min, digest.max = data["min"], data["max"]
+        return digest
+
+
+# --- HYPERLOGLOG ---
+
+def _hash64(values):
+    ## splitmix64 finaliser: a cheap, well-mixed 64-bit hash of integer ids
+    with np.errstate(over="ignore"):
+        x = values.astype(np.uint64) + np.uint64(0x9E3779B97F4A7C15)
+        x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        return x ^ (x >> np.uint64(31))
+
+
+class HyperLogLog:
+
+    ## Distinct count in 2**precision one-byte registers (16KB at the default precision of 14,
+    ## with a standard error of about 0.8%)
+
+    def __init__(self, precision=14):
+        self.precision = precision
+        self.registers = np.zeros(2 ** precision, dtype=np.uint8)
+
+    def update(self, values):
+        values = np.asarray(values)
+        if not len(values):
+            return self
+        hashes = _hash64(values)
+        index = (hashes >> np.uint64(64 - self.precision)).astype(np.intp)
+        ## rank = position of the first set bit after the index bits; the top 32 of the remaining
+        ## bits convert exactly to float, and a longer run of zeros is vanishingly unlikely
+        rest = ((hashes << np.uint64(self.precision)) >> np.uint64(32)).astype(np.float64)
+        rank = np.where(rest > 0, 32 - np.floor(np.log2(np.maximum(rest, 1))), 33).astype(np.uint8)
+        np.maximum.at(self.registers, index, rank)
+        return self
+
+    def merge(self, other):
+        np.maximum(self.registers, other.registers, out=self.registers)
+        return self
+
+    def count(self):
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / np.sum(np.ldexp(1.0, -self.registers.astype(int)))
+        zeros = int(np.sum(self.registers == 0))
+        if estimate <= 2.5 * m and zeros:
+            ## linear counting while many registers are empty
+            estimate = m * np.log(m / zeros)
+        return int(round(estimate))
+
+    def to_dict(self):
+        return {"precision": self.precision, "registers": base64.b64encode(self.registers.tobytes()).decode("ascii")}
+
+    @classmethod
+    def from_dict(cls, data):
+        sketch = cls(data["precision"])
+        sketch.registers = np.frombuffer(base64.b64decode(data["registers"]), dtype=np.uint8).copy()
+        return sketch
+
+
+# --- COLUMN SKETCHES ---
+
+class ColumnSketch:
+
+    def __init__(self, name, kind):
+        self.name = name
+        self.kind = kind  # "date", "numeric", "category", "flag" or "id"
+        self.n = 0
+        self.missing = 0
+        self.min = None
+        self.max = None
+        self.digest = TDigest() if name in QUANTILE_COLUMNS else None
+        self.counts = Counter() if kind in ("category", "flag") else None
+        self.distinct = HyperLogLog() if kind == "id" else None
+
+    def missing_mask(self, values):
+        if self.kind == "date":
+            return np.isnat(values)
+        if self.kind == "category":
+            return values == ""
+        missing = np.isnan(values) if values.dtype.kind == "f" else np.zeros(len(values), dtype=bool)
+        if self.kind == "numeric":
+            missing |= values == 0
+        return missing
+
+    def update(self, values):
+        values = np.asarray(values)
+        present = values[~self.missing_mask(values)]
+        self.n += len(values)
+        self.missing += len(values) - len(present)
+
+        if len(present) and self.kind in ("date", "numeric"):
+            low, high = present.min(), present.max()
+            self.min = low if self.min is None else min(self.min, low)
+            self.max = high if self.max is None else max(self.max, high)
+        if self.digest is not None:
+            self.digest.update(present)
+        if self.counts is not None:
+            levels, counts = np.unique(present, return_counts=True)
+            self.counts.update(dict(zip(levels.tolist(), counts.tolist())))
+        if self.distinct is not None:
+            self.distinct.update(present)
+
+    def to_dict(self):
+        def scalar(value):
+            if value is None:
+                return None
+            return str(value) if self.kind == "date" else value.item()
+
+        return {
+            "kind": self.kind,
+            "n": self.n,
+            "missing": self.missing,
+            "min": scalar(self.min),
+            "max": scalar(self.max),
+            "quantiles": self.digest.to_dict() if self.digest is not None else None,
+            "counts": {str(level): count for level, count in sorted(self.counts.items())} if self.counts is not None else None,
+            "distinct": self.distinct.to_dict() if self.distinct is not None else None,
+        }
+
+
+def column_kinds(study):
+    ## Sketch kind for each cohort column, from what the study definition returns
+    kinds = {"patient_id": "id"}
+    for variable in study.variables:
+        kinds[variable.name] = _KINDS.get(variable.returning, "numeric")
+    return kinds
+
+
+class CohortSketch:
+
+    def __init__(self, kinds):
+        self.columns = {name: ColumnSketch(name, kind) for name, kind in kinds.items()}
+
+    @classmethod
+    def for_study(cls, study):
+        return cls(column_kinds(study))
+
+    def update(self, chunk):
+        for name, values in chunk.items():
+            if name in self.columns:
+                self.columns[name].update(values)
+
+    def to_dict(self, **metadata):
+        return dict(metadata, columns={name: column.to_dict() for name, column in self.columns.items()})
+
+    def write(self, path, **metadata):
+        with open(path, "w") as f:
+            json.dump(self.to_dict(**metadata), f, indent=2)
+        return Path(path)
+
+
+def sketch_path(cohort_path):
+    ## Named after the cohort file, eg input.csv -> input_sketch.json
+    cohort_path = Path(cohort_path)
+    return cohort_path.parent / f"{cohort_path.stem}_sketch.json"
+
+
+def read_sketch(cohort_path):
+    ## The sketch written with a cohort file, or None if there is none or it describes a different
+    ## file (tied to the cohort by its md5, as for the date offsets sidecar)
+    path = sketch_path(cohort_path)
+    if not path.exists():
+        return None
+    summary = json.loads(path.read_text())
+    if summary.get("cohort_md5") != file_md5(cohort_path):
+        return None
+    return summary
+
+
+# --- STREAMING A COHORT FILE ---
+
+_OFFSET = re.compile(r"^-?\d+$")
+
+
+def _parse(values, kind, index_date=None):
+    if kind == "date" and index_date is not None:
+        ## int16 day offsets from index_date (lib/local_extraction.py --date-offsets)
+        invalid = [value for value in values if value and not _OFFSET.match(value)]
+        if invalid:
+            raise ValueError(f"'{invalid[0]}' is not a day offset; the cohort's dates are not offsets from {index_date}")
+        return DateOffsets(index_date).decode([int(value) if value else DateOffsets.MISSING for value in values])
+    if kind == "date":
+        return np.array(values, dtype="datetime64[D]")
+    if kind == "category":
+        return np.array(values, dtype=str)
+    if kind in ("id", "flag"):
+        return np.array([int(value) if value else 0 for value in values], dtype=np.int64)
+    return np.array([float(value) if value else np.nan for value in values])
+
+
+def sketch_csv(path, kinds, chunk_size=100_000, index_date=None):
+    sketch = CohortSketch(kinds)
+    with open(path, newline="") as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        wanted = [(i, name) for i, name in enumerate(header) if name in kinds]
+        while True:
+            rows = [row for _, row in zip(range(chunk_size), reader)]
+            if not rows:
+                break
+            sketch.update({name: _parse([row[i] for row in rows], kinds[name], index_date) for i, name in wanted})
+    return sketch
+
+
+# --- REPORT ---
+
+def report(summary, threshold=5):
+    ## Text summary of a sketch JSON. Category counts are redacted with redactor(), as in
+    ## lib/redaction_functions.R; missing counts are redacted against the non-missing count.
+    lines = [f"{summary.get('cohort', '')}: {summary['columns']['patient_id']['n']} rows", ""]
+
+    lines.append(f"{'column':<45} {'kind':<9} {'missing':>10} {'min':>12} {'max':>12} {'distinct':>10}")
+    for name, column in summary["columns"].items():
+        missing = column["missing"]
+        if redactor([missing, column["n"] - missing], threshold)[0]:
+            missing = "[redacted]"
+        distinct = HyperLogLog.from_dict(column["distinct"]).count() if column["distinct"] else ""
+        low = "" if column["min"] is None else column["min"]
+        high = "" if column["max"] is None else column["max"]
+        lines.append(f"{name:<45} {column['kind']:<9} {missing!s:>10} {low!s:>12} {high!s:>12} {distinct!s:>10}")
+
+    lines += ["", "## Quantiles"]
+    for name, column in summary["columns"].items():
+        if column["quantiles"] and column["quantiles"]["weights"]:
+            digest = TDigest.from_dict(column["quantiles"])
+            lines.append(f"{name}: " + "  ".join(f"{q:.0%}={digest.quantile(q):.1f}" for q in QUANTILES))
+
+    lines += ["", "## Category counts"]
+    for name, column in summary["columns"].items():
+        if column["counts"] is None:
+            continue
+        lines.append(name)
+        levels = list(column["counts"])
+        counts = [column["counts"][level] for level in levels]
+        for level, count, redact in zip(levels, counts, redactor(counts, threshold)):
+            lines.append(f"  {level:<20} {'[redacted]' if redact else count:>10}")
+
+    return "\n".join(lines) + "\n"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Summarise a cohort with streaming sketches")
+    parser.add_argument("cohort", help="extracted cohort, eg output/input.csv")
+    parser.add_argument("--study-definition", default="study_definition")
+    parser.add_argument("--analysis-dir", default=str(ROOT / "analysis"))
+    parser.add_argument("--output-dir", default=str(ROOT / "output" / "data_properties"))
+    parser.add_argument("--threshold", type=int, default=5, help="redaction threshold for the report")
+    args = parser.parse_args(argv)
+
+    ## Use the sketch written during extraction if it is up to date; otherwise stream the cohort file
+    summary = read_sketch(args.cohort)
+    if summary is None:
+        study = load_study_definition(args.study_definition, args.analysis_dir)
+        ## dates are offsets only if the sidecar describes this cohort file (see lib/date_offsets.py)
+        offsets = read_date_offsets(args.cohort)
+        index_date = offsets["index_date"] if offsets is not None else None
+        summary = sketch_csv(args.cohort, column_kinds(study), index_date=index_date).to_dict(cohort=Path(args.cohort).name)
+
+    output_dir = Path(args.output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    stem = Path(args.cohort).stem
+    (output_dir / f"{stem}_sketch.json").write_text(json.dumps(summary, indent=2))
+    (output_dir / f"{stem}_sketch.txt").write_text(report(summary, args.threshold))
+
+
+if __name__ == "__main__":
+    main()
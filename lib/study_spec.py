@@ -0,0 +1,283 @@
+######################################
+
+# This script:
+# - reads a study definition (eg analysis/study_definition.py) and the codelists it imports
+#   without importing cohortextractor, by walking the python syntax tree
+# - returns a plain description of each variable (function, arguments, nested variables)
+# - is used by the local extraction tools in lib/ which evaluate these descriptions
+#   against a local event store
+
+######################################
+
+
+# --- IMPORT STATEMENTS ---
+
+import ast
+import csv
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+
+# --- CODELISTS ---
+
+@dataclass
+class Codelist:
+    system: str
+    name: Optional[str] = None
+    path: Optional[str] = None
+    column: Optional[str] = None
+    category_column: Optional[str] = None
+    literal_codes: Optional[List[str]] = None
+    parts: List["Codelist"] = field(default_factory=list)
+    root: Optional[Path] = None
+
+    _codes: Optional[np.ndarray] = field(default=None, repr=False)
+    _categories: Optional[np.ndarray] = field(default=None, repr=False)
+
+    def load(self):
+        ## Read codes (and categories, if any) on first use; most codelists are never needed
+        if self._codes is not None:
+            return self._codes, self._categories
+
+        if self.parts:
+            loaded = [part.load() for part in self.parts]
+            codes = np.concatenate([c for c, _ in loaded])
+            if all(cat is not None for _, cat in loaded):
+                categories = np.concatenate([cat for _, cat in loaded])
+            else:
+                categories = None
+        elif self.literal_codes is not None:
+            codes = list(self.literal_codes)
+            categories = None
+        else:
+            with open(Path(self.root) / self.path, newline="") as f:
+                rows = list(csv.DictReader(f))
+            codes = [row[self.column] for row in rows]
+            categories = None
+            if self.category_column is not None:
+                categories = np.array([row[self.category_column] for row in rows])
+
+        codes = _as_code_array(codes)
+        self._codes, self._categories = codes, categories
+        return codes, categories
+
+    def __len__(self):
+        return len(self.load()[0])
+
+
+def _as_code_array(codes):
+    ## SNOMED codes fit in int64, which is how the event store holds them; other systems stay as strings
+    codes = np.asarray(codes)
+    if codes.dtype.kind in "iu":
+        return codes.astype(np.int64)
+    if len(codes) and all(str(code).isdigit() for code in codes):
+        return codes.astype(np.int64)
+    return codes.astype(str)
+
+
+# --- VARIABLES ---
+
+@dataclass
+class VariableSpec:
+    name: str
+    function: str
+    args: List[Any]
+    kwargs: Dict[str, Any]
+    nested: List["VariableSpec"] = field(default_factory=list)
+    hidden: bool = False
+    lineno: Optional[int] = None
+
+    @property
+    def returning(self):
+        return self.kwargs.get("returning", _DEFAULT_RETURNING.get(self.function))
+
+    @property
+    def codelist(self):
+        ## The codelist passed to the variable itself, whatever the backend
+        for value in list(self.args) + list(self.kwargs.values()):
+            if isinstance(value, Codelist):
+                return value
+        return None
+
+    def backend_codelist(self, backend):
+        ## The codelist used on one backend: the variable's own, or one in its options for that backend
+        ## (eg with_vaccination_record(emis={"procedure_codes": ...}), which TPP matches by target disease)
+        if self.codelist is not None:
+            return self.codelist
+        for value in (self.kwargs.get(backend) or {}).values():
+            if isinstance(value, Codelist):
+                return value
+        return None
+
+    def walk(self):
+        ## Nested variables first, so that the parent can refer to them
+        for child in self.nested:
+            yield from child.walk()
+        yield self
+
+
+_DEFAULT_RETURNING = {
+    "with_these_clinical_events": "binary_flag",
+    "with_these_medications": "binary_flag",
+    "with_vaccination_record": "binary_flag",
+    "died_from_any_cause": "binary_flag",
+    "registered_as_of": "binary_flag",
+    "registered_with_one_practice_between": "binary_flag",
+    "satisfying": "binary_flag",
+    "all": "binary_flag",
+    "date_deregistered_from_all_supported_practices": "date",
+    "age_as_of": "int",
+    "sex": "category",
+    "categorised_as": "category",
+    "registered_practice_as_of": "pseudo_id",
+    "address_as_of": "index_of_multiple_deprivation",
+}
+
+
+@dataclass
+class StudySpec:
+    name: str
+    path: Path
+    index_date: str
+    population: VariableSpec
+    variables: List[VariableSpec]
+
+    @property
+    def output_columns(self):
+        return [variable.name for variable in self.variables]
+
+    def walk(self):
+        ## Every variable in evaluation order: population first, then the study variables as defined
+        yield from self.population.walk()
+        for variable in self.variables:
+            yield from variable.walk()
+
+
+# --- LOADING ---
+
+_CODELIST_FUNCTIONS = {"codelist_from_csv", "codelist", "combine_codelists"}
+
+
+class _Evaluator:
+
+    def __init__(self, env, root, path):
+        self.env = env
+        self.root = root
+        self.path = path
+
+    def value(self, node, name=None):
+        if isinstance(node, ast.Constant):
+            return node.value
+        if isinstance(node, ast.Name):
+            if node.id not in self.env:
+                raise self.error(node, f"unknown name '{node.id}'")
+            return self.env[node.id]
+        if isinstance(node, ast.List):
+            return [self.value(item) for item in node.elts]
+        if isinstance(node, ast.Tuple):
+            return tuple(self.value(item) for item in node.elts)
+        if isinstance(node, ast.Dict):
+            return {self.value(k): self.value(v) for k, v in zip(node.keys, node.values)}
+        if isinstance(node, ast.Call):
+            func = node.func
+            if isinstance(func, ast.Attribute) and isinstance(func.value, ast.Name) and func.value.id == "patients":
+                return self.variable(node, func.attr, name)
+            if isinstance(func, ast.Name) and func.id in _CODELIST_FUNCTIONS:
+                return self.codelist(node, func.id, name)
+        raise self.error(node, f"unsupported expression {ast.dump(node)[:60]}")
+
+    def variable(self, node, function, name):
+        args = [self.value(arg) for arg in node.args]
+        kwargs = {}
+        nested = []
+        for keyword in node.keywords:
+            value = self.value(keyword.value, name=keyword.arg)
+            if isinstance(value, VariableSpec):
+                value.hidden = True
+                nested.append(value)
+            else:
+                kwargs[keyword.arg] = value
+        return VariableSpec(name=name, function=function, args=args, kwargs=kwargs, nested=nested, lineno=node.lineno)
+
+    def codelist(self, node, function, name):
+        args = [self.value(arg) for arg in node.args]
+        kwargs = {keyword.arg: self.value(keyword.value) for keyword in node.keywords}
+        if function == "codelist_from_csv":
+            path = args[0] if args else kwargs["filename"]
+            return Codelist(
+                name=name,
+                path=path,
+                system=kwargs.get("system"),
+                column=kwargs.get("column", "code"),
+                category_column=kwargs.get("category_column"),
+                root=self.root,
+            )
+        if function == "codelist":
+            return Codelist(name=name, literal_codes=list(args[0]), system=kwargs.get("system", args[1] if len(args) > 1 else None))
+        return Codelist(name=name, system=args[0].system, parts=list(args))
+
+    def error(self, node, message):
+        return ValueError(f"{self.path}:{getattr(node, 'lineno', '?')}: {message}")
+
+
+def _module_env(tree, evaluator):
+    ## Module-level constants (eg start_date) and codelists, in source order
+    for statement in tree.body:
+        if isinstance(statement, ast.ImportFrom) and statement.module == "codelists":
+            evaluator.env.update(load_codelists(evaluator.path.parent / "codelists.py", evaluator.root))
+        elif isinstance(statement, ast.Assign) and len(statement.targets) == 1 and isinstance(statement.targets[0], ast.Name):
+            target = statement.targets[0].id
+            if isinstance(statement.value, ast.Call) and getattr(statement.value.func, "id", None) == "StudyDefinition":
+                continue
+            try:
+                evaluator.env[target] = evaluator.value(statement.value, name=target)
+            except ValueError:
+                pass
+
+
+def load_codelists(path, root=None):
+    path = Path(path)
+    root = Path(root) if root is not None else path.parent.parent
+    tree = ast.parse(path.read_text(), filename=str(path))
+    evaluator = _Evaluator({}, root, path)
+    _module_env(tree, evaluator)
+    return {name: value for name, value in evaluator.env.items() if isinstance(value, Codelist)}
+
+
+def load_study_definition(name, analysis_dir="analysis"):
+    analysis_dir = Path(analysis_dir)
+    path = analysis_dir / f"{name}.py"
+    tree = ast.parse(path.read_text(), filename=str(path))
+    evaluator = _Evaluator({}, analysis_dir.resolve().parent, path)
+    _module_env(tree, evaluator)
+
+    calls = [
+        node for node in ast.walk(tree)
+        if isinstance(node, ast.Call) and getattr(node.func, "id", None) == "StudyDefinition"
+    ]
+    if len(calls) != 1:
+        raise ValueError(f"{path}: expected exactly one StudyDefinition, found {len(calls)}")
+
+    index_date = None
+    population = None
+    variables = []
+    for keyword in calls[0].keywords:
+        if keyword.arg == "default_expectations":
+            continue
+        if keyword.arg == "index_date":
+            index_date = evaluator.value(keyword.value)
+            evaluator.env["index_date"] = index_date
+            continue
+        value = evaluator.value(keyword.value, name=keyword.arg)
+        if keyword.arg == "population":
+            population = value
+        else:
+            variables.append(value)
+
+    if population is None:
+        raise ValueError(f"{path}: StudyDefinition has no population")
+
+    return StudySpec(name=name, path=path, index_date=index_date, population=population, variables=variables)
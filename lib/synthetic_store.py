@@ -0,0 +1,204 @@
+######################################
+
+# This script:
+# - generates a synthetic local event store (see lib/event_store.py) shaped like this study:
+#   mostly 70+ patients, multi-year clinical event and medication histories drawn from the
+#   codelists in analysis/codelists.py, registrations, addresses, deaths and vaccinations
+# - writes patients in chunks, so stores of tens of millions of patients fit in memory
+# - shapes the store like either backend (--backend): TPP records vaccinations by target disease,
+#   EMIS as immunisation procedure codes (see lib/event_store.py)
+# - optionally partitions the event tables by event year/month, with zone maps (--partitioned)
+#
+# Usage:
+#   python lib/synthetic_store.py --patients 1000000 --output output/benchmarks/store_1000000
+#   python lib/synthetic_store.py --patients 1000000 --output output/backends/stores/emis --backend emis
+#   python lib/synthetic_store.py --patients 1000000 --output output/benchmarks/store_1000000_partitioned --partitioned
+
+######################################
+
+
+# --- IMPORT STATEMENTS ---
+
+import argparse
+from pathlib import Path
+
+import numpy as np
+
+from event_store import EVENT_TABLES, TableWriter, partition_table
+from study_spec import load_codelists
+
+
+ROOT = Path(__file__).resolve().parent.parent
+
+INDEX_DATE = np.datetime64("2020-12-07")
+END_DATE = np.datetime64("2021-03-17")
+HISTORY_START = np.datetime64("1990-01-01")
+
+PATIENTS_PER_PRACTICE = 1200
+
+
+# --- GENERATION ---
+
+def study_codes(codelists_path=ROOT / "analysis" / "codelists.py"):
+    ## Numeric (SNOMED) codes from each of the study's codelists, by codelist name
+    codelists = {name: codelist.load()[0] for name, codelist in load_codelists(codelists_path, ROOT).items()}
+    return {name: codes for name, codes in codelists.items() if codes.dtype.kind == "i" and len(codes)}
+
+
+def random_dates(rng, start, end, size):
+    return start + rng.integers(0, int((end - start).astype(int)) + 1, size)
+
+
+def generate_chunk(rng, first_id, n, n_practices, codelists, events_per_patient, medications_per_patient, backend="tpp"):
+    patient_id = np.arange(first_id, first_id + n, dtype=np.int64)
+
+    ## Patients: three quarters 70+ at 2020-03-31, the rest younger so the population filter has work to do
+    age = np.where(rng.random(n) < 0.75, rng.integers(70, 105, n), rng.integers(40, 70, n))
+    date_of_birth = np.datetime64("2020-03-31") - (age * 365.25).astype(int) - rng.integers(0, 365, n)
+    sex = rng.choice(np.array(["F", "M", "I", "U"]), n, p=[0.51, 0.4895, 0.0005, 0.0])
+    died = rng.random(n)
+    date_of_death = np.full(n, np.datetime64("NaT"), dtype="datetime64[D]")
+    before = died < 0.04
+    during = (died >= 0.04) & (died < 0.06)
+    date_of_death[before] = random_dates(rng, np.datetime64("2015-01-01"), INDEX_DATE, before.sum())
+    date_of_death[during] = random_dates(rng, INDEX_DATE + 1, END_DATE, during.sum())
+    patients = dict(patient_id=patient_id, date_of_birth=date_of_birth, sex=sex, date_of_death=date_of_death)
+
+    ## Registrations: an earlier closed registration for some, and a current one for everyone
+    practice = rng.integers(1, n_practices + 1, n)
+    current_start = random_dates(rng, np.datetime64("1995-01-01"), INDEX_DATE, n)
+    current_start[before] = np.minimum(current_start[before], date_of_death[before] - 1)
+    current_end = np.full(n, np.datetime64("NaT"), dtype="datetime64[D]")
+    deregistered = rng.random(n) < 0.01
+    current_end[deregistered] = random_dates(rng, INDEX_DATE + 1, END_DATE, deregistered.sum())
+    current_end[before | during] = date_of_death[before | during]
+    moved = rng.random(n) < 0.3
+    registrations = dict(
+        patient_id=np.concatenate([patient_id, patient_id[moved]]),
+        practice_pseudo_id=np.concatenate([practice, rng.integers(1, n_practices + 1, moved.sum())]),
+        start_date=np.concatenate([current_start, current_start[moved] - rng.integers(365, 7300, moved.sum())]),
+        end_date=np.concatenate([current_end, current_start[moved] - 1]),
+    )
+
+    ## Addresses: deprivation rank (1-32844), missing for 1%
+    has_address = rng.random(n) >= 0.01
+    addresses = dict(
+        patient_id=patient_id[has_address],
+        start_date=random_dates(rng, np.datetime64("1980-01-01"), INDEX_DATE, has_address.sum()),
+        end_date=np.full(has_address.sum(), np.datetime64("NaT"), dtype="datetime64[D]"),
+        index_of_multiple_deprivation=rng.integers(1, 32845, has_address.sum()),
+    )
+
+    ## Clinical events: a third from the study codelists, the rest background codes never matched
+    events = rng.poisson(events_per_patient, n)
+    event_patient = np.repeat(patient_id, events)
+    m = len(event_patient)
+    from_codelist = rng.random(m) < 1 / 3
+    which = rng.integers(0, len(codelists), m)
+    code = rng.integers(10**14, 10**15, m)
+    for i, codes in enumerate(codelists.values()):
+        chosen = from_codelist & (which == i)
+        code[chosen] = rng.choice(codes, chosen.sum())
+    numeric_value = np.full(m, np.nan)
+    is_bmi = np.isin(code, codelists["bmi_codes"])
+    numeric_value[is_bmi] = rng.normal(27, 5, is_bmi.sum()).round(1)
+    clinical_events = dict(
+        patient_id=event_patient,
+        date=random_dates(rng, HISTORY_START, END_DATE, m),
+        code=code,
+        numeric_value=numeric_value,
+    )
+
+    ## Medications: mostly recent prescriptions, a tenth from the immunosuppression codelist
+    prescriptions = rng.poisson(medications_per_patient, n)
+    medication_patient = np.repeat(patient_id, prescriptions)
+    k = len(medication_patient)
+    medication_code = rng.integers(10**14, 10**15, k)
+    immunosuppression = rng.random(k) < 0.1
+    medication_code[immunosuppression] = rng.choice(codelists["immunosuppression_medication_codes"], immunosuppression.sum())
+    medications = dict(
+        patient_id=medication_patient,
+        date=random_dates(rng, np.datetime64("2015-01-01"), END_DATE, k),
+        code=medication_code,
+    )
+
+    ## Vaccinations: COVID for most patients during follow-up, plus yearly flu for half
+    covid = rng.random(n) < 0.8
+    flu_years = rng.integers(0, 6, n) * (rng.random(n) < 0.5)
+    flu_patient = np.repeat(patient_id, flu_years)
+    vaccinations = dict(
+        patient_id=np.concatenate([patient_id[covid], flu_patient]),
+        date=np.concatenate([
+            random_dates(rng, INDEX_DATE + 1, END_DATE, covid.sum()),
+            random_dates(rng, np.datetime64("2015-09-01"), np.datetime64("2020-03-31"), len(flu_patient)),
+        ]),
+        target_disease=np.concatenate([
+            np.full(covid.sum(), "SARS-2 CORONAVIRUS"),
+            np.full(len(flu_patient), "INFLUENZA"),
+        ]),
+    )
+
+    tables = dict(
+        patients=patients,
+        registrations=registrations,
+        addresses=addresses,
+        clinical_events=clinical_events,
+        medications=medications,
+    )
+    if backend == "emis":
+        ## The same vaccinations, as procedure codes: COVID from the EMIS codelist, flu from background codes
+        covid_records = vaccinations["target_disease"] == "SARS-2 CORONAVIRUS"
+        code = rng.integers(10**14, 10**15, len(covid_records))
+        code[covid_records] = rng.choice(codelists["covid_vaccine_EMIS_codes"], covid_records.sum())
+        tables["immunisations"] = dict(patient_id=vaccinations["patient_id"], date=vaccinations["date"], code=code)
+    else:
+        tables["vaccinations"] = vaccinations
+    return tables
+
+
+def generate_store(root, n_patients, seed=0, chunk_size=250_000, events_per_patient=30, medications_per_patient=10,
+                   backend="tpp", partitioned=False):
+    rng = np.random.default_rng(seed)
+    codelists = study_codes()
+    n_practices = max(1, n_patients // PATIENTS_PER_PRACTICE)
+
+    writers = {}
+    try:
+        for first in range(0, n_patients, chunk_size):
+            n = min(chunk_size, n_patients - first)
+            chunk = generate_chunk(rng, first + 1, n, n_practices, codelists, events_per_patient, medications_per_patient,
+                                   backend=backend)
+            for table, columns in chunk.items():
+                if table not in writers:
+                    writers[table] = TableWriter(root, table)
+                writers[table].append(columns)
+    finally:
+        for writer in writers.values():
+            writer.close()
+
+    ## Written in patient order first, then each event table is split by month, one table in memory at a time
+    if partitioned:
+        for table in EVENT_TABLES:
+            if table in writers:
+                partition_table(root, table)
+    return {table: writer.length for table, writer in writers.items()}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate a synthetic local event store")
+    parser.add_argument("--patients", type=int, required=True)
+    parser.add_argument("--output", required=True)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--events-per-patient", type=int, default=30)
+    parser.add_argument("--backend", choices=["tpp", "emis"], default="tpp")
+    parser.add_argument("--partitioned", action="store_true", help="partition event tables by event year/month")
+    args = parser.parse_args(argv)
+
+    rows = generate_store(args.output, args.patients, seed=args.seed, events_per_patient=args.events_per_patient,
+                          backend=args.backend, partitioned=args.partitioned)
+    for table, n in rows.items():
+        print(f"{table:<20} {n:>12,} rows")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+import sys
+import textwrap
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+
+## The tools in lib/ are scripts that import each other directly, so put lib/ on the path as they see it
+LIB = Path(__file__).resolve().parent.parent / "lib"
+sys.path.insert(0, str(LIB))
+
+
+STUDY_DEFINITION = '''
+from cohortextractor import StudyDefinition, patients, codelist
+
+asthma_codes = codelist(["100", "200"], system="snomed")
+
+study = StudyDefinition(
+    index_date = "2021-01-01",
+    population = patients.all(),
+    asthma = patients.with_these_clinical_events(asthma_codes, on_or_before = "index_date"),
+    asthma_first = patients.with_these_clinical_events(
+        asthma_codes, on_or_before = "index_date", returning = "date", find_first_match_in_period = True,
+    ),
+    asthma_last = patients.with_these_clinical_events(
+        asthma_codes, on_or_before = "index_date", returning = "date", find_last_match_in_period = True,
+    ),
+    asthma_count = patients.with_these_clinical_events(
+        asthma_codes, on_or_before = "index_date", returning = "number_of_matches_in_period",
+    ),
+    asthma_value = patients.with_these_clinical_events(
+        asthma_codes, on_or_before = "index_date", returning = "numeric_value", find_last_match_in_period = True,
+    ),
+    asthma_after = patients.with_these_clinical_events(
+        asthma_codes, on_or_after = "index_date + 1 day", returning = "date", find_first_match_in_period = True,
+    ),
+)
+'''
+
+
+@pytest.fixture
+def tiny_study(tmp_path):
+    ## A study definition using clinical events only, loaded as lib/local_extraction.py would
+    from study_spec import load_study_definition
+
+    analysis = tmp_path / "analysis"
+    analysis.mkdir()
+    (analysis / "study_definition.py").write_text(textwrap.dedent(STUDY_DEFINITION))
+    return load_study_definition("study_definition", analysis)
+
+
+@pytest.fixture
+def tiny_store(tmp_path):
+    ## Four patients: 1 has events before and after index_date and one code not in the codelist,
+    ## 2 has one old event, 3 has none, and 4 has one event on index_date
+    from event_store import write_table
+
+    store = tmp_path / "store"
+    write_table(store, "patients", {
+        "patient_id": [1, 2, 3, 4],
+        "date_of_birth": np.array(["1940-01-01"] * 4, dtype="datetime64[D]"),
+        "sex": ["F", "M", "F", "M"],
+        "date_of_death": np.array(["NaT"] * 4, dtype="datetime64[D]"),
+    })
+    write_table(store, "clinical_events", {
+        "patient_id": [1, 1, 1, 1, 2, 4],
+        "date": np.array(["2020-06-01", "2019-05-01", "2020-07-01", "2021-02-01", "2015-03-15", "2021-01-01"],
+                         dtype="datetime64[D]"),
+        "code": [200, 100, 300, 100, 200, 100],
+        "numeric_value": [21.5, 20.0, 99.0, 23.0, 25.0, 30.0],
+    })
+    return store
@@ -0,0 +1,43 @@
+import numpy as np
+
+from benchmark import r_schema, read_cohort
+
+
+def test_r_schema_follows_00_process_data():
+    schema = r_schema()
+    assert schema["patient_id"] == "integer"
+    assert schema["covid_vax_1_date"] == "study_date"
+    assert schema["bmi"] == "double"
+    assert schema["diabetes"] == "logical"
+    assert schema["sex"] == "character"
+    ## commented-out columns are not read
+    assert "region" not in schema
+
+
+def test_read_cohort_in_chunks(tmp_path):
+    path = tmp_path / "input.csv"
+    path.write_text(
+        "patient_id,covid_vax_1_date,bmi,diabetes,ethnicity,unused\n"
+        "1,2020-12-21,31.5,1,1,x\n"
+        "2,,,0,,y\n"
+        "3,2021-01-04,0,1,12,z\n"
+    )
+    schema = {"patient_id": "integer", "covid_vax_1_date": "study_date", "bmi": "double", "diabetes": "logical",
+              "ethnicity": "character"}
+
+    columns = read_cohort(path, schema, chunk_size=2)
+
+    assert list(columns) == list(schema)
+    np.testing.assert_array_equal(columns["patient_id"], [1, 2, 3])
+    np.testing.assert_array_equal(columns["covid_vax_1_date"], np.array(["2020-12-21", "NaT", "2021-01-04"], dtype="datetime64[D]"))
+    np.testing.assert_array_equal(columns["bmi"], [31.5, np.nan, 0.0])
+    np.testing.assert_array_equal(columns["diabetes"], [True, False, True])
+    ## string columns are as wide as the widest value in any chunk
+    np.testing.assert_array_equal(columns["ethnicity"], ["1", "", "12"])
+
+
+def test_read_cohort_empty(tmp_path):
+    path = tmp_path / "input.csv"
+    path.write_text("patient_id,bmi\n")
+    columns = read_cohort(path, {"patient_id": "integer", "bmi": "double"})
+    assert len(columns["patient_id"]) == 0 and columns["bmi"].dtype == np.float64
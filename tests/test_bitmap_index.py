@@ -0,0 +1,100 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from bitmap_index import BitmapIndex, derived_categories, derived_flags, index_path
+
+
+NAT = "NaT"
+
+## Eleven rows, so the last byte of each bitset has padding bits
+COHORT = {
+    "patient_id": np.arange(1, 12),
+    "age": np.array([70, 74, 75, 79, 80, 85, 90, 94, 95, 101, 72]),
+    "sex": np.array(["F", "M", "F", "M", "F", "M", "F", "M", "F", "M", ""]),
+    "imd": np.array([1, 2, 3, 4, 5, 0, 1, 2, 3, 4, 5]),
+    "ethnicity": np.array(["1", "", "2", "", "", "3", "1", "2", "3", "", "1"]),
+    "ethnicity_other": np.array([NAT, "2020-01-01", NAT, NAT, NAT, NAT, NAT, NAT, NAT, NAT, NAT], dtype="datetime64[D]"),
+    "ethnicity_not_stated": np.array([NAT, NAT, NAT, "2020-01-01", NAT, NAT, NAT, NAT, NAT, NAT, NAT], dtype="datetime64[D]"),
+    "diabetes": np.array([1, 0, 1, 1, 0, 0, 1, 0, 0, 1, 1]),
+    "asthma": np.array(["2019-01-01", NAT, NAT, "2020-05-01", NAT, NAT, NAT, NAT, "2018-02-02", NAT, NAT],
+                       dtype="datetime64[D]"),
+    "immunosuppression_diagnosis": np.array([1, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0]),
+    "immunosuppression_medication": np.array([0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 1]),
+}
+
+STUDY = SimpleNamespace(variables=[
+    SimpleNamespace(name="diabetes", returning="binary_flag"),
+    SimpleNamespace(name="asthma", returning="date"),
+    SimpleNamespace(name="age", returning="age"),
+])
+
+
+@pytest.fixture
+def index():
+    return BitmapIndex.build(COHORT, STUDY)
+
+
+def test_counts_match_filtering_the_cohort(index):
+    diabetes = COHORT["diabetes"] == 1
+    female = COHORT["sex"] == "F"
+    assert index.count() == 11
+    assert index.count("diabetes") == diabetes.sum()
+    assert index.count("asthma") == 3
+    assert index.count("diabetes", "sex=F") == (diabetes & female).sum()
+    np.testing.assert_array_equal(index.mask("diabetes", "sex=F"), diabetes & female)
+
+
+def test_negation_clears_padding_bits(index):
+    assert index.count("!diabetes") == 11 - index.count("diabetes")
+    assert index.count("!diabetes", "!asthma") == (~(COHORT["diabetes"] == 1) & np.isnat(COHORT["asthma"])).sum()
+    assert index.bitset("!diabetes")[-1] & 0b00011111 == 0
+    with pytest.raises(KeyError, match="no bitset 'smoking'"):
+        index.count("smoking")
+
+
+def test_cascade(index):
+    assert index.cascade(["diabetes", "!asthma", "sex=F"]) == [
+        ("all", 11), ("diabetes", 6), ("!asthma", 4), ("sex=F", 2),
+    ]
+
+
+def test_crosstab(index):
+    rows, columns, table = index.crosstab("sex", "imd")
+    assert rows == ["F", "M"]
+    assert columns == ["1", "2", "3", "4", "5"]
+    ## the missing sex and imd 0 are not levels
+    assert table.sum() == 9
+    assert table[rows.index("F"), columns.index("1")] == 2
+
+    _, _, within = index.crosstab("sex", "imd", "diabetes")
+    assert within.sum() == ((COHORT["diabetes"] == 1) & (COHORT["sex"] != "") & (COHORT["imd"] != 0)).sum()
+
+
+def test_save_and_load(tmp_path, index):
+    path = index.save(index_path(tmp_path / "input.csv"))
+    assert path.name == "input_bitmaps.npz"
+    loaded = BitmapIndex.load(path)
+    assert loaded.n == 11
+    assert loaded.bitsets.keys() == index.bitsets.keys()
+    assert loaded.count("!diabetes", "ageband=70-74") == index.count("!diabetes", "ageband=70-74")
+
+
+def test_derived_covariates_follow_00_process_data():
+    ## agebands are [low, high), with 95+ open ended
+    ageband = derived_categories(COHORT)["ageband"]
+    assert {label: int(values.sum()) for label, values in ageband.items()} == {
+        "70-74": 3, "75-79": 2, "80-84": 1, "85-89": 1, "90-94": 2, "95+": 2,
+    }
+
+    ## missing ethnicity falls back to the "other" (17) and "not stated" (19) codes, then 20
+    ethnicity = derived_categories(COHORT)["ethnicity"]
+    assert sorted(ethnicity) == ["1", "17", "19", "2", "20", "3"]
+    assert np.flatnonzero(ethnicity["17"]).tolist() == [1]
+    assert np.flatnonzero(ethnicity["19"]).tolist() == [3]
+    assert np.flatnonzero(ethnicity["20"]).tolist() == [4, 9]
+
+    flags = derived_flags(COHORT)
+    assert np.flatnonzero(flags["immunosuppression"]).tolist() == [0, 10]
+    assert "ckd" not in flags
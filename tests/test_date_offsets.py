@@ -0,0 +1,51 @@
+import numpy as np
+import pytest
+
+from date_offsets import DateOffsets, date_offsets_path, read_date_offsets
+
+
+def test_round_trip():
+    offsets = DateOffsets("2020-12-07")
+    values = np.array(["2020-12-07", "NaT", "1940-01-01", "2021-03-17"], dtype="datetime64[D]")
+    encoded = offsets.encode(values)
+
+    assert encoded.dtype == np.int16
+    np.testing.assert_array_equal(encoded, [0, DateOffsets.MISSING, -29561, 100])
+    np.testing.assert_array_equal(offsets.decode(encoded), values)
+    np.testing.assert_array_equal(offsets.format(encoded)[:2], ["0", ""])
+
+
+def test_month_dates_are_first_of_month():
+    offsets = DateOffsets("2020-12-07")
+    encoded = offsets.encode(np.array(["2020-12-25"], dtype="datetime64[D]"), date_format="YYYY-MM")
+    np.testing.assert_array_equal(encoded, [-6])
+
+
+def test_out_of_range():
+    offsets = DateOffsets("2020-12-07")
+    with pytest.raises(ValueError, match="int16"):
+        offsets.encode(np.array(["1900-01-01"], dtype="datetime64[D]"))
+    with pytest.raises(ValueError, match="int16"):
+        offsets.encode(np.array(["2120-01-01"], dtype="datetime64[D]"))
+
+
+def test_sidecar_only_applies_to_its_cohort(tmp_path):
+    cohort = tmp_path / "input.csv"
+    cohort.write_text("patient_id,covid_vax_1_date\n1,14\n")
+    DateOffsets("2020-12-07").write(date_offsets_path(cohort), ["covid_vax_1_date"], cohort)
+    assert read_date_offsets(cohort)["index_date"] == "2020-12-07"
+
+    ## eg an ISO-dated cohort written over it, or restored from a cache, with the sidecar left behind
+    cohort.write_text("patient_id,covid_vax_1_date\n1,2020-12-21\n")
+    assert read_date_offsets(cohort) is None
+
+
+def test_sketches_read_offsets_back():
+    from sketches import _parse
+
+    np.testing.assert_array_equal(
+        _parse(["0", "", "-29561", "100"], "date", index_date="2020-12-07"),
+        np.array(["2020-12-07", "NaT", "1940-01-01", "2021-03-17"], dtype="datetime64[D]"),
+    )
+    with pytest.raises(ValueError, match="not a day offset"):
+        _parse(["2020-12-21"], "date", index_date="2020-12-07")
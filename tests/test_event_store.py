@@ -0,0 +1,51 @@
+import shutil
+
+import numpy as np
+import pytest
+
+from event_store import EVENT_TABLES, partition_table, zone_maps
+from local_extraction import LocalExtractor
+from study_spec import load_study_definition
+from synthetic_store import ROOT, generate_store
+
+
+def assert_same_cohort(left, right):
+    assert left.keys() == right.keys()
+    for name in left:
+        np.testing.assert_array_equal(left[name], right[name], err_msg=name)
+
+
+def test_partitioned_store_gives_same_cohort(tmp_path, tiny_study, tiny_store):
+    partitioned = tmp_path / "partitioned"
+    shutil.copytree(tiny_store, partitioned)
+    partition_table(partitioned, "clinical_events")
+
+    assert [zone["partition"] for zone in zone_maps(partitioned, "clinical_events")] == [
+        "2015-03", "2019-05", "2020-06", "2020-07", "2021-01", "2021-02",
+    ]
+    assert_same_cohort(LocalExtractor(tiny_study, tiny_store).extract(),
+                       LocalExtractor(tiny_study, partitioned).extract())
+
+
+def test_partitions_pruned_by_window_and_codes(tmp_path, tiny_study, tiny_store):
+    partition_table(tiny_store, "clinical_events")
+    extractor = LocalExtractor(tiny_study, tiny_store)
+    codelist = next(variable for variable in tiny_study.variables if variable.name == "asthma").codelist
+
+    assert extractor.partitions("clinical_events", lower=np.datetime64("2021-01-02")) == [(5, 6)]
+    ## 2020-07 only has code 300, outside the codelist's code range
+    assert extractor.partitions("clinical_events", upper=np.datetime64("2021-01-01"), codelist=codelist) == [(0, 3), (4, 5)]
+    ## no patient has a lower bound, so nothing can match
+    assert extractor.partitions("clinical_events", lower=np.array(["NaT", "NaT"], dtype="datetime64[D]")) == []
+
+
+@pytest.mark.parametrize("backend", ["tpp", "emis"])
+def test_partitioned_synthetic_store_gives_same_cohort(tmp_path, backend):
+    study = load_study_definition("study_definition", ROOT / "analysis")
+    generate_store(tmp_path / "store", 300, seed=1, backend=backend)
+    generate_store(tmp_path / "partitioned", 300, seed=1, backend=backend, partitioned=True)
+
+    assert all((tmp_path / "partitioned" / table / "zone_maps.json").exists()
+               for table in EVENT_TABLES if (tmp_path / "store" / table).exists())
+    assert_same_cohort(LocalExtractor(study, tmp_path / "store", backend=backend).extract(),
+                       LocalExtractor(study, tmp_path / "partitioned", backend=backend).extract())
@@ -0,0 +1,89 @@
+import csv
+import json
+
+import pytest
+
+from extraction_profile import ExtractionProfiler, NullProfiler, VariableProfile, register_hook, unregister_hook
+from local_extraction import LocalExtractor
+from study_spec import load_study_definition
+from synthetic_store import ROOT
+
+
+@pytest.fixture
+def events():
+    ## Every (event, variable name) a registered hook sees
+    seen = []
+
+    def hook(event, record):
+        seen.append((event, record.name))
+
+    register_hook(hook)
+    yield seen
+    unregister_hook(hook)
+
+
+def test_hooks_see_start_and_end_of_each_variable(tiny_study, tiny_store, events):
+    LocalExtractor(tiny_study, tiny_store, profiler=ExtractionProfiler(track_memory=False)).extract()
+
+    names = [spec.name for spec in tiny_study.walk()]
+    assert events[:2 * len(names)] == [(event, name) for name in names for event in ("start", "end")]
+    assert events[-2:] == [("start", "population_filter"), ("end", "population_filter")]
+
+
+def test_hooks_fire_with_profiling_off(tiny_study, tiny_store, events):
+    LocalExtractor(tiny_study, tiny_store).extract()
+    assert ("end", "asthma_first") in events
+
+
+def test_subscribe_to_one_profiler(tiny_study, tiny_store):
+    seen = []
+    profiler = ExtractionProfiler(track_memory=False)
+    profiler.subscribe(lambda event, record: seen.append((event, record.name)))
+    LocalExtractor(tiny_study, tiny_store, profiler=profiler).extract()
+    assert ("end", "asthma_count") in seen
+
+    ## other profilers don't see it
+    seen.clear()
+    LocalExtractor(tiny_study, tiny_store, profiler=ExtractionProfiler(track_memory=False)).extract()
+    assert seen == []
+
+
+@pytest.mark.parametrize("profiler", [ExtractionProfiler(track_memory=False), NullProfiler()])
+def test_end_fires_when_a_variable_raises(profiler, events):
+    with pytest.raises(RuntimeError):
+        with profiler.measure(VariableProfile(name="broken")):
+            raise RuntimeError("failed")
+    assert events == [("start", "broken"), ("end", "broken")]
+
+
+def test_records_and_sidecars(tiny_study, tiny_store, tmp_path):
+    profiler = ExtractionProfiler()
+    extractor = LocalExtractor(tiny_study, tiny_store, profiler=profiler)
+    extractor.extract()
+    profiler.close()
+
+    records = {record.name: record for record in profiler.records}
+    assert records["asthma"].codelist_size == 2
+    assert records["asthma"].rows_scanned == 6
+    assert records["asthma"].rows_matched == 4
+    assert records["asthma"].peak_memory is not None
+    assert records["population_filter"].kind == "stage"
+
+    json_path, csv_path = profiler.write(tmp_path / "input.csv", backend="tpp")
+    assert json_path.name == "input_profile.json" and csv_path.name == "input_profile.csv"
+    summary = json.loads(json_path.read_text())
+    assert summary["backend"] == "tpp"
+    assert [record["name"] for record in summary["records"]] == list(records)
+    with open(csv_path, newline="") as f:
+        rows = list(csv.DictReader(f))
+    assert [row["name"] for row in rows] == list(records)
+    assert rows[0]["rows_scanned"] == str(records[rows[0]["name"]].rows_scanned)
+
+
+def test_codelist_size_is_for_the_active_backend():
+    ## TPP finds vaccinations by target disease; only EMIS uses the procedure codelist
+    study = load_study_definition("study_definition", ROOT / "analysis")
+    spec = next(spec for spec in study.walk() if spec.name == "covid_vax_1_date")
+    assert spec.codelist is None
+    assert spec.backend_codelist("tpp") is None
+    assert spec.backend_codelist("emis") is not None
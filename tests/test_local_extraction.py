@@ -0,0 +1,53 @@
+import numpy as np
+import pytest
+
+from local_extraction import LocalExtractor, add_months, parse_date_expression
+
+
+def dates(*values):
+    return np.array(values, dtype="datetime64[D]")
+
+
+# --- DATES ---
+
+def test_parse_date_expression():
+    assert parse_date_expression("index_date") == ("index_date", None, 0)
+    assert parse_date_expression("index_date + 1 day") == ("index_date", "day", 1)
+    assert parse_date_expression("index_date - 1 year") == ("index_date", "month", -12)
+
+
+@pytest.mark.parametrize("date, months, expected", [
+    ("2021-01-31", 1, "2021-02-28"),
+    ("2020-01-31", 1, "2020-02-29"),
+    ("2020-03-31", -1, "2020-02-29"),
+    ("2020-02-29", 12, "2021-02-28"),
+    ("2020-12-07", -12, "2019-12-07"),
+])
+def test_add_months_clips_to_month_end(date, months, expected):
+    assert add_months(np.datetime64(date), months) == np.datetime64(expected)
+
+
+def test_add_months_arrays():
+    np.testing.assert_array_equal(add_months(dates("2021-01-31", "2021-03-15"), 1), dates("2021-02-28", "2021-04-15"))
+
+
+# --- REDUCTIONS ---
+
+def test_event_reductions(tiny_study, tiny_store):
+    extractor = LocalExtractor(tiny_study, tiny_store)
+    cohort = extractor.extract()
+
+    np.testing.assert_array_equal(cohort["patient_id"], [1, 2, 3, 4])
+    np.testing.assert_array_equal(cohort["asthma"], [1, 1, 0, 1])
+    np.testing.assert_array_equal(cohort["asthma_first"], dates("2019-05-01", "2015-03-15", "NaT", "2021-01-01"))
+    np.testing.assert_array_equal(cohort["asthma_last"], dates("2020-06-01", "2015-03-15", "NaT", "2021-01-01"))
+    np.testing.assert_array_equal(cohort["asthma_count"], [2, 1, 0, 1])
+    np.testing.assert_array_equal(cohort["asthma_value"], [21.5, 25.0, 0.0, 30.0])
+    np.testing.assert_array_equal(cohort["asthma_after"], dates("2021-02-01", "NaT", "NaT", "NaT"))
+
+
+def test_pick_first_and_last_of_each_run():
+    positions = np.array([0, 0, 0, 2, 3, 3])
+    np.testing.assert_array_equal(LocalExtractor.pick(positions, "first"), [True, False, False, True, True, False])
+    np.testing.assert_array_equal(LocalExtractor.pick(positions, "last"), [False, False, True, True, False, True])
+    assert len(LocalExtractor.pick(np.zeros(0, dtype=int), "first")) == 0
@@ -0,0 +1,27 @@
+import pytest
+
+from redaction import redactor, redactor2
+
+
+## Expected values follow redactor() in lib/redaction_functions.R, including which.min() taking the
+## first of tied frequencies, and a zero being the "next smallest" frequency
+@pytest.mark.parametrize("n, threshold, expected", [
+    ([10, 3, 20], 5, [True, True, False]),
+    ([10, 3, 4, 20], 5, [False, True, True, False]),
+    ([10, 6, 20], 5, [False, False, False]),
+    ([0, 10, 20], 5, [False, False, False]),
+    ([0, 2, 10], 5, [True, True, False]),
+    ([8, 2, 8], 5, [True, True, False]),
+    ([1, 1, 1], 5, [True, True, True]),
+])
+def test_redactor_matches_r(n, threshold, expected):
+    assert redactor(n, threshold) == expected
+
+
+def test_redactor2():
+    assert redactor2([10, 3, 20]) == [None, None, 20]
+    assert redactor2([10, 3, 20], x=["a", "b", "c"]) == [None, None, "c"]
+    with pytest.raises(ValueError, match="same length"):
+        redactor2([10, 3, 20], x=[1, 2])
+    with pytest.raises(ValueError, match="non-missing"):
+        redactor2([None, None])
@@ -0,0 +1,159 @@
+import sys
+import textwrap
+
+import pytest
+
+import run_pipeline
+from run_pipeline import (
+    ActionCache, Telemetry, action_sources, command, execute, execution_order, flag_regressions, load_project,
+    read_telemetry, run_action, run_actions, write_telemetry,
+)
+
+
+PROJECT = '''
+version: '3.0'
+actions:
+  extract:
+    run: python:latest analysis/extract.py
+    outputs:
+      highly_sensitive:
+        cohort: output/cohort.csv
+  summarise:
+    run: python:latest analysis/summarise.py
+    needs: [extract]
+    outputs:
+      moderately_sensitive:
+        summary: output/summary.txt
+  broken:
+    run: python:latest analysis/broken.py
+    needs: [extract]
+    outputs:
+      moderately_sensitive:
+        nothing: output/nothing.txt
+'''
+
+SCRIPTS = {
+    "extract.py": "open('output/cohort.csv', 'w').write('patient_id\\n1\\n2\\n')",
+    "summarise.py": "n = len(open('output/cohort.csv').readlines()) - 1\nopen('output/summary.txt', 'w').write(f'{n} rows\\n')",
+    "broken.py": "raise SystemExit(3)",
+}
+
+
+@pytest.fixture
+def project(tmp_path, monkeypatch):
+    ## A small project.yaml with python actions, as the repo root
+    monkeypatch.setattr(run_pipeline, "ROOT", tmp_path)
+    (tmp_path / "project.yaml").write_text(PROJECT)
+    (tmp_path / "analysis").mkdir()
+    (tmp_path / "output").mkdir()
+    for name, source in SCRIPTS.items():
+        (tmp_path / "analysis" / name).write_text(textwrap.dedent(source))
+    return load_project(tmp_path / "project.yaml")
+
+
+def test_load_project(project):
+    assert project["summarise"].needs == ["extract"]
+    assert project["extract"].outputs == ["output/cohort.csv"]
+
+
+def test_execution_order(project):
+    assert execution_order(project, ["summarise"]) == ["extract", "summarise"]
+    assert execution_order(project) == ["extract", "summarise", "broken"]
+    with pytest.raises(ValueError, match="unknown action"):
+        execution_order(project, ["missing"])
+
+
+def test_execution_order_finds_cycles(project):
+    project["extract"].needs = ["summarise"]
+    with pytest.raises(ValueError, match="dependency cycle"):
+        execution_order(project, ["summarise"])
+
+
+def test_command(project, tmp_path):
+    assert command(project["extract"]) == [sys.executable, "analysis/extract.py"]
+    action = run_pipeline.Action(name="r", run="r:latest analysis/model.R", needs=[], outputs=[])
+    assert command(action) == ["Rscript", "analysis/model.R"]
+    extract = run_pipeline.Action(name="cohort", run="cohortextractor:latest generate_cohort --study-definition study_definition",
+                                  needs=[], outputs=[])
+    assert command(extract, store=tmp_path / "store")[1:4] == [str(tmp_path / "lib" / "local_extraction.py"), "--study-definition", "study_definition"]
+
+
+def test_run_action_telemetry(project, tmp_path):
+    extract = run_action(project["extract"], project)
+    assert (extract.status, extract.returncode) == ("succeeded", 0)
+    assert extract.output_bytes == (tmp_path / "output" / "cohort.csv").stat().st_size
+    assert extract.wall_time > 0 and extract.peak_rss > 0
+
+    summarise = run_action(project["summarise"], project)
+    assert summarise.status == "succeeded"
+    assert summarise.input_bytes == extract.output_bytes
+    assert (tmp_path / "metadata" / "summarise.log").exists()
+
+    broken = run_action(project["broken"], project)
+    assert (broken.status, broken.returncode) == ("failed", 3)
+
+
+def test_telemetry_round_trip_and_regressions(tmp_path):
+    baseline = [Telemetry(action="model", status="succeeded", wall_time=10.0, cpu_time=9.0, peak_rss=100, output_bytes=50)]
+    write_telemetry(baseline, tmp_path / "baseline.csv")
+    previous = read_telemetry(tmp_path / "baseline.csv")
+    assert float(previous["model"]["wall_time"]) == 10.0
+
+    records = [Telemetry(action="model", status="succeeded", wall_time=13.0, cpu_time=9.5, peak_rss=100, output_bytes=50)]
+    assert flag_regressions(records, previous, tolerance=0.2) == records
+    assert records[0].regressions == "wall_time(+30%)"
+
+
+# --- CACHE ---
+
+def add_tool(root, project):
+    ## A python action in lib/ that imports a local helper module, which imports study_spec
+    (root / "lib").mkdir()
+    (root / "lib" / "tool.py").write_text("from helper import label\nopen('output/label.txt', 'w').write(label)\n")
+    (root / "lib" / "helper.py").write_text("import study_spec\nlabel = 'first'\n")
+    (root / "lib" / "study_spec.py").write_text("")
+    (root / "analysis" / "study_definition.py").write_text("index_date = '2020-12-07'\n")
+    (root / "analysis" / "codelists.py").write_text("")
+    project["tool"] = run_pipeline.Action(name="tool", run="python:latest lib/tool.py", needs=[], outputs=["output/label.txt"])
+    return project["tool"]
+
+
+def test_python_sources_follow_local_imports(project, tmp_path):
+    tool = add_tool(tmp_path, project)
+    sources = {path.relative_to(tmp_path).as_posix() for path in action_sources(tool)}
+    assert {"lib/tool.py", "lib/helper.py", "lib/study_spec.py", "analysis/study_definition.py", "analysis/codelists.py"} <= sources
+    ## scripts that don't load a study definition don't depend on it
+    assert {path.name for path in action_sources(project["extract"])} == {"extract.py"}
+
+
+def test_changed_import_is_not_a_cache_hit(project, tmp_path):
+    tool = add_tool(tmp_path, project)
+    cache = ActionCache(tmp_path / ".pipeline_cache")
+
+    assert execute(tool, project, cache=cache).status == "succeeded"
+    assert execute(tool, project, cache=cache).status == "cached"
+
+    (tmp_path / "lib" / "helper.py").write_text("import study_spec\nlabel = 'second'\n")
+    assert execute(tool, project, cache=cache).status == "succeeded"
+    assert (tmp_path / "output" / "label.txt").read_text() == "second"
+
+    (tmp_path / "analysis" / "codelists.py").write_text("# changed\n")
+    assert execute(tool, project, cache=cache).status == "succeeded"
+
+
+def test_cache_restores_outputs_and_tracks_needs(project, tmp_path):
+    cache = ActionCache(tmp_path / ".pipeline_cache")
+    records, failed = run_actions(project, ["extract", "summarise", "broken"], cache=cache, jobs=2)
+    assert [record.status for record in records] == ["succeeded", "succeeded", "failed"]
+    assert failed == {"broken"}
+
+    (tmp_path / "output" / "summary.txt").unlink()
+    records, _ = run_actions(project, ["extract", "summarise"], cache=cache, jobs=2)
+    assert [record.status for record in records] == ["cached", "cached"]
+    assert (tmp_path / "output" / "summary.txt").read_text() == "2 rows\n"
+
+    ## a changed input (the output of a needed action) reruns the action that reads it
+    (tmp_path / "analysis" / "extract.py").write_text("open('output/cohort.csv', 'w').write('patient_id\\n1\\n')")
+    records, _ = run_actions(project, ["extract", "summarise"], cache=cache, jobs=2)
+    assert [record.status for record in records] == ["succeeded", "succeeded"]
+    assert (tmp_path / "output" / "summary.txt").read_text() == "1 rows\n"
@@ -0,0 +1,69 @@
+import json
+import os
+
+import numpy as np
+
+import local_extraction
+import sketches
+from sketches import ColumnSketch, HyperLogLog, TDigest
+
+
+def test_tdigest_quantiles():
+    values = np.random.default_rng(0).normal(80, 7, 100_000)
+    digest = TDigest()
+    for chunk in np.array_split(values, 10):
+        digest.update(chunk)
+
+    assert digest.count == len(values)
+    for q in (0.01, 0.5, 0.99):
+        assert abs(digest.quantile(q) - np.quantile(values, q)) < 0.2
+    restored = TDigest.from_dict(digest.to_dict())
+    assert restored.quantile(0.5) == digest.quantile(0.5)
+
+
+def test_hyperloglog_counts():
+    sketch = HyperLogLog()
+    sketch.update(np.arange(50_000) % 1_000)
+    assert abs(sketch.count() - 1_000) <= 10
+
+    sketch.update(np.arange(100_000))
+    assert abs(sketch.count() - 100_000) / 100_000 < 0.03
+
+    merged = HyperLogLog()
+    merged.merge(HyperLogLog.from_dict(sketch.to_dict()))
+    assert merged.count() == sketch.count()
+
+
+def test_missing_values_follow_00_process_data():
+    dates = ColumnSketch("covid_vax_1_date", "date")
+    dates.update(np.array(["2021-01-01", "NaT", "NaT"], dtype="datetime64[D]"))
+    assert (dates.n, dates.missing) == (3, 2)
+
+    bmi = ColumnSketch("bmi", "numeric")
+    bmi.update(np.array([0.0, np.nan, 31.2]))
+    assert bmi.missing == 2
+
+
+def test_sketch_is_reused_only_for_the_cohort_it_describes(tmp_path, tiny_study, tiny_store):
+    output = tmp_path / "output"
+    local_extraction.main(["--store", str(tiny_store), "--analysis-dir", str(tmp_path / "analysis"),
+                           "--output-dir", str(output)])
+    cohort = output / "input.csv"
+    args = [str(cohort), "--analysis-dir", str(tmp_path / "analysis"), "--output-dir", str(tmp_path / "properties")]
+
+    def summary():
+        sketches.main(args)
+        return json.loads((tmp_path / "properties" / "input_sketch.json").read_text())
+
+    ## the sketch written during extraction is used as is
+    reused = summary()
+    assert reused["backend"] == "tpp"
+    assert reused["columns"]["patient_id"]["n"] == 4
+
+    ## a changed cohort is streamed again, even though the sketch is newer than it
+    lines = cohort.read_text().splitlines(keepends=True)
+    cohort.write_text("".join(lines[:-1]))
+    os.utime(output / "input_sketch.json", (os.path.getmtime(cohort) + 60,) * 2)
+    streamed = summary()
+    assert "backend" not in streamed
+    assert streamed["columns"]["patient_id"]["n"] == 3